@@ -1,33 +1,31 @@
-import json
-
-def generate_recommendations(sim_matrix_path, sim_sorted_path, tid, top_num, 
-                             duplicate_thresh, irrelevant_thresh):
+def generate_recommendations(recoms, pairs, top_num, duplicate_thresh, trade_off):
     '''
-    Given the similarity matrix, generate top_num recommendations for
-    target_tid
+    Picks up to top_num of a topic's stored recommendations by maximal
+    marginal relevance: each pick maximizes
+    trade_off * relevance - (1 - trade_off) * (max similarity to the picks so far),
+    where relevance is the score relative to the top score, and
+    candidates too similar to a pick are dropped as duplicates
     Args:
-    sim_matrix_path:   file path for computed similarity matrix
-    sim_sorted_path:   file path for sorted similarity lists
-    tid:               topic id to generate recommendations fopr
+    recoms:            list of [id, score]'s sorted by score
+    pairs:             len(recoms) x len(recoms) similarities among recoms,
+                       or None to return recoms as they are
     top_num:           maximum number of topics to recommend
     duplicate_thresh:  threshold value for duplicate
-    irrelevant_thresh: threshold value for irrelevance 
+    trade_off:         weight of relevance against novelty, 1 keeps the
+                       stored order apart from dropping duplicates
     '''
-    with open(sim_matrix_path, 'r') as f1, open(sim_sorted_path, 'r') as f2:
-        sim_matrix, sim_sorted = json.load(f1), json.load(f2)
+    if pairs is None or not recoms:
+        return recoms[:top_num]
+
+    top_score = recoms[0][1] if recoms[0][1] > 0 else 1.0
 
-    recoms, sim_list = [], sim_sorted[tid]
-    i = 0
-    while len(recoms) < top_num:
-        tid, sim_val = sim_list[i]
-        if sim_val < irrelevant_thresh:
-            break
-        if sim_val < duplicate_thresh:
-            if len(recoms) == 0:
-                recoms.append((tid, sim_val))
-            else:
-                prev_tid = recoms[-1][0]
-                if sim_matrix[tid][prev_tid] < duplicate_thresh:
-                    recoms.append((tid, sim_val))
+    picked, remaining = [], list(range(len(recoms)))
+    max_sims = [0.0]*len(recoms)
+    while remaining and len(picked) < top_num:
+        best = max(remaining, key=lambda i: trade_off*recoms[i][1]/top_score - (1-trade_off)*max_sims[i])
+        picked.append(best)
+        remaining = [i for i in remaining if i != best and pairs[best][i] < duplicate_thresh]
+        for i in remaining:
+            max_sims[i] = max(max_sims[i], pairs[best][i])
 
-    return recoms
\ No newline at end of file
+    return [recoms[i] for i in picked]
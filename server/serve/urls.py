@@ -4,4 +4,7 @@ from . import views
 
 urlpatterns = [
     path('', views.serve_recommendations, name='serve_recommendations'),
+    path('batch/', views.serve_batch, name='serve_batch'),
+    path('topic_model/', views.serve_topic_model, name='serve_topic_model'),
+    path('cache_stats/', views.cache_stats, name='cache_stats'),
 ]
\ No newline at end of file
@@ -4,4 +4,6 @@ from . import views
 
 urlpatterns = [
     path('', views.serve_recommendations, name='serve_recommendations'),
+    path('batch/', views.serve_batch, name='serve_batch'),
+    path('cache_stats/', views.cache_stats, name='cache_stats'),
 ]
\ No newline at end of file
@@ -6,12 +6,14 @@ import sys
 import logging
 from datetime import datetime
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 root_dir = os.path.dirname(sys.path[0])
 config_path = os.path.abspath(os.path.join(root_dir, 'config'))
 source_path = os.path.abspath(os.path.join(root_dir, 'source'))
 sys.path.insert(0, config_path)
 sys.path.insert(1, source_path)
 import utils
+from store import RecommendationStore
 
 
 # read configurations
@@ -27,6 +29,7 @@ path_cfg = config['paths']
 log_cfg = config['logging']
 recom_cfg = config['recommendation']
 misc_cfg = config['miscellaneous']
+serve_cfg = config['serving']
 
 logger = utils.get_logger_with_config(name=log_cfg['serve_log_name'],
                                       logger_level=log_cfg['log_level'],
@@ -36,12 +39,36 @@ logger = utils.get_logger_with_config(name=log_cfg['serve_log_name'],
                                       log_format=log_cfg['format'])
 
 
+store = RecommendationStore(path_cfg['recommendation_store'],
+                            max_recoms={'topics': recom_cfg['max_stored'],
+                                        'specials': recom_cfg['max_stored_special'],
+                                        'inference': recom_cfg['max_stored']})
+
+
+def load_recommendations(tid):
+    recoms = store.get('specials', tid, recom_cfg['max_shown_special'])
+    if recoms is None:
+        raise KeyError('No recommendations stored for topic {}'.format(tid))
+
+    return [x[0] for x in recoms]
+
+
+# recommendations of recently requested topics, keyed by topic id and
+# reloaded whenever the consumer has written to the store
+cache = utils.LRUCache(max_size=serve_cfg['cache_size'],
+                       check_every=serve_cfg['cache_check_every'],
+                       loader=load_recommendations,
+                       signature=lambda tid: store.version())
+
+# threads running the lookups of batched requests
+executor = ThreadPoolExecutor(max_workers=serve_cfg['batch_workers'])
+
+
 def serve_recommendations(request):
     '''
     Given the similarity matrix, generate top_num recommendations for
     target_tid
     '''
-    print(config)
     if request.method == 'POST':
         return JsonResponse({'status': True,
                              'errorCode': 1,
@@ -49,23 +76,79 @@ def serve_recommendations(request):
                              'dto': {'list': []},
                              '_t': datetime.now().timestamp()})
 
-    dir = path_cfg['special_save_dir']
-    file_name = os.path.join(dir, str(request.GET['topicID']))
+    tid = str(request.GET['topicID'])
 
     try:
-        with open(file_name, 'r') as f:
-            data = json.load(f)
-
-        recoms = [x[0] for x in data[:recom_cfg['max_shown_special']]]
+        recoms = cache.get(tid)
         return JsonResponse({'status': True,
                              'errorCode': 0,
                              'errorMessage': '',
                              'dto': {'list': recoms},
                              '_t': datetime.now().timestamp()})
     except:
-        logger.exception('Data file unavailable or corrupted')
+        logger.exception('Recommendations unavailable for topic %s', tid)
         return JsonResponse({'status': True,
                              'errorCode': 2,
-                             'errorMessage': 'Data file unavailable or corrupted',
+                             'errorMessage': 'Recommendations unavailable',
                              'dto': {'list': []},
                              '_t': datetime.now().timestamp()})
+
+
+async def serve_batch(request):
+    '''
+    Returns the recommendations of every topic in the comma-separated
+    topicIDs parameter. Topics are looked up concurrently, and those not
+    resolved within budgetMs milliseconds (at most batch_budget_ms) are
+    reported with errorCode 3 while the others are returned as usual
+    '''
+    if request.method == 'POST':
+        return JsonResponse({'status': True,
+                             'errorCode': 1,
+                             'errorMessage': 'Method not allowed!',
+                             'dto': {'results': {}},
+                             '_t': datetime.now().timestamp()})
+
+    tids = list(dict.fromkeys(tid for tid in request.GET.get('topicIDs', '').split(',') if tid))
+    try:
+        budget = min(float(request.GET.get('budgetMs', serve_cfg['batch_budget_ms'])),
+                     serve_cfg['batch_budget_ms'])
+    except ValueError:
+        budget = None
+
+    if not 0 < len(tids) <= serve_cfg['batch_max_topics'] or budget is None:
+        return JsonResponse({'status': True,
+                             'errorCode': 4,
+                             'errorMessage': 'Expected 1 to {} topic ids and a numeric budget'.format(
+                                 serve_cfg['batch_max_topics']),
+                             'dto': {'results': {}},
+                             '_t': datetime.now().timestamp()})
+
+    lookups = await utils.lookup_within(cache.get, tids, budget/1000, executor)
+
+    results = {}
+    for tid, (recoms, error, elapsed) in lookups.items():
+        if elapsed is None:
+            results[tid] = {'errorCode': 3, 'errorMessage': 'Timed out', 'list': [], 'elapsedMs': None}
+        elif error is not None:
+            logger.warning('Recommendations unavailable for topic %s: %r', tid, error)
+            results[tid] = {'errorCode': 2, 'errorMessage': 'Recommendations unavailable',
+                            'list': [], 'elapsedMs': elapsed*1000}
+        else:
+            results[tid] = {'errorCode': 0, 'errorMessage': '', 'list': recoms, 'elapsedMs': elapsed*1000}
+
+    return JsonResponse({'status': True,
+                         'errorCode': 0,
+                         'errorMessage': '',
+                         'dto': {'results': results, 'budgetMs': budget},
+                         '_t': datetime.now().timestamp()})
+
+
+def cache_stats(request):
+    '''
+    Reports the size and hit/miss counters of the recommendation cache
+    '''
+    return JsonResponse({'status': True,
+                         'errorCode': 0,
+                         'errorMessage': '',
+                         'dto': cache.stats(),
+                         '_t': datetime.now().timestamp()})
@@ -0,0 +1,91 @@
+import re
+import json
+import time
+import argparse
+import yaml
+import jieba
+from classes import TextPreprocessor
+import utils
+
+
+def reference_punc_ratio(preprocessor, text):
+    cnt = 0
+    for c in text:
+        if c in preprocessor.puncs:
+            cnt += 1
+
+    return cnt / len(text)
+
+
+def reference_filter_tokens(preprocessor, words):
+    '''
+    Token filter as implemented before the compiled fast path, kept as
+    the baseline for speed and output comparison
+    '''
+    alphanum, whitespace = r'\\*\w+', r'\s'
+    word_list = []
+
+    for word in words:
+        if len(word) == 1 \
+                or re.match(alphanum, word, flags=re.ASCII) \
+                or re.match(whitespace, word, flags=re.ASCII) \
+                or word in preprocessor.stopwords \
+                or any(c in preprocessor.singles for c in word) \
+                or len(word) / len(set(word)) > 2:
+            continue
+        word_list.append(word)
+
+    return word_list
+
+
+def timed(func, inputs, repeat):
+    best, outputs = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [func(x) for x in inputs]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def main(args):
+    with open('config/config.yml', 'rb') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    pre_cfg = config['preprocessing']
+    preprocessor = TextPreprocessor(singles=pre_cfg['singles'],
+                                    puncs=pre_cfg['punctuations'],
+                                    punc_frac_low=pre_cfg['min_punc_frac'],
+                                    punc_frac_high=pre_cfg['max_punc_frac'],
+                                    valid_count=pre_cfg['min_count'],
+                                    valid_ratio=pre_cfg['min_ratio'],
+                                    stopwords=utils.load_stopwords(config['paths']['stopwords']))
+
+    with open(config['paths']['topics'], 'r') as f:
+        texts = [topic['body'] for topic in json.load(f).values() if topic['body']]
+
+    # tokenize once so that only the filtering is timed
+    tokens = [jieba.lcut(text, cut_all=False) for text in texts]
+    num_tokens = sum(len(words) for words in tokens)
+
+    t_old, out_old = timed(lambda words: reference_filter_tokens(preprocessor, words), tokens, args.repeat)
+    t_new, out_new = timed(preprocessor.filter_tokens, tokens, args.repeat)
+    assert out_old == out_new, 'token filter output differs from the reference implementation'
+
+    p_old, ratios_old = timed(lambda text: reference_punc_ratio(preprocessor, text), texts, args.repeat)
+    p_new, ratios_new = timed(preprocessor.punc_ratio, texts, args.repeat)
+    assert ratios_old == ratios_new, 'punctuation ratios differ from the reference implementation'
+
+    num_chars = sum(len(text) for text in texts)
+    print('{} documents, {} tokens, {} characters'.format(len(texts), num_tokens, num_chars))
+    print('token filter:      {:>12,.0f} tokens/sec before, {:>12,.0f} tokens/sec after ({:.1f}x)'.format(
+        num_tokens/t_old, num_tokens/t_new, t_old/t_new))
+    print('punctuation ratio: {:>12,.0f} chars/sec before,  {:>12,.0f} chars/sec after ({:.1f}x)'.format(
+        num_chars/p_old, num_chars/p_new, p_old/p_new))
+    print('outputs identical')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timing runs, the best one is reported')
+    args = parser.parse_args()
+    main(args)
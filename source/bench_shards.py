@@ -0,0 +1,72 @@
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+import yaml
+from classes import TextPreprocessor, CorpusSimilarity
+import utils
+
+
+def build(records, num_shards, batch_size, recom_cfg):
+    corpus = CorpusSimilarity(name='TOPICS',
+                              time_decay=recom_cfg['time_decay_base'],
+                              duplicate_thresh=recom_cfg['duplicate_thresh'],
+                              irrelevant_thresh=recom_cfg['irrelevant_thresh'],
+                              max_recoms=recom_cfg['max_stored'],
+                              logger=logging.getLogger('bench'),
+                              max_overflow=recom_cfg['max_overflow'],
+                              num_shards=num_shards)
+    start = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+        corpus.add_batch(records[i:i+batch_size])
+    elapsed = time.perf_counter() - start
+    if corpus.shards is not None:
+        corpus.shards.close()
+
+    return elapsed, {tid: list(data['sim_list']) for tid, data in corpus.data.items()}
+
+
+def main(args):
+    with open('config/config.yml', 'rb') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    pre_cfg = config['preprocessing']
+    preprocessor = TextPreprocessor(singles=pre_cfg['singles'],
+                                    puncs=pre_cfg['punctuations'],
+                                    punc_frac_low=pre_cfg['min_punc_frac'],
+                                    punc_frac_high=pre_cfg['max_punc_frac'],
+                                    valid_count=pre_cfg['min_count'],
+                                    valid_ratio=pre_cfg['min_ratio'],
+                                    stopwords=utils.load_stopwords(config['paths']['stopwords']))
+
+    with open(config['paths']['topics'], 'r') as f:
+        topics = json.load(f)
+
+    # tokenize once, then repeat the corpus under new id's to enlarge it
+    datetime_format = config['miscellaneous']['datetime_format']
+    tokenized = [(topic_id, preprocessor.preprocess(topic['body']),
+                  int(datetime.strptime(topic['POSTDATE'], datetime_format).timestamp()))
+                 for topic_id, topic in topics.items()]
+    records = [('{}-{}'.format(topic_id, k), content, date)
+               for k in range(args.copies) for topic_id, content, date in tokenized]
+
+    baseline = None
+    print('{} topics, batches of {}'.format(len(records), args.batch_size))
+    for num_shards in args.shards:
+        elapsed, sim_lists = build(records, num_shards, args.batch_size, config['recommendation'])
+        if baseline is None:
+            baseline = sim_lists
+        same = sim_lists == baseline
+        print('{:>2} shards: {:>10,.0f} topics/sec{}'.format(
+            num_shards, len(records)/elapsed, '' if same else ' (similarity lists differ from the first run)'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--shards', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='shard counts to compare, 0 scores in the calling process')
+    parser.add_argument('-n', '--copies', type=int, default=20, help='number of copies of the topics to add')
+    parser.add_argument('-b', '--batch-size', type=int, default=32, help='number of topics per batch')
+    args = parser.parse_args()
+    main(args)
@@ -1,21 +1,45 @@
 # class definitions
 import re
+import sys
 import time
 import os
 import glob
 import math
+import io
 import json
-from gensim import corpora, matutils
-from gensim.models import tfidfmodel, LdaModel
+import shutil
+import copy
+import pickle
+import multiprocessing
+import threading
+import zlib
+from collections import defaultdict
+from itertools import chain
+from gensim import corpora
+from gensim.models import tfidfmodel, LdaModel, KeyedVectors
 #from gensim.similarities import Similarity
 from gensim.models import Word2Vec
 import numpy as np
+from scipy import sparse
 import jieba
-from utils import insert, remove
+from utils import TopK, discard, atomic_write
 
 NUM_SECONDS_PER_DAY = 86400
 
+def to_ragged(lists, dtype):
+    '''
+    Packs a list of lists into an offsets array and a flat value array
+    '''
+    indptr = np.zeros(len(lists)+1, dtype=np.int64)
+    np.cumsum([len(l) for l in lists], out=indptr[1:])
+    values = np.fromiter(chain.from_iterable(lists), dtype=dtype, count=indptr[-1])
+    return indptr, values
+
+
 class TextPreprocessor(object):
+    # a leading ASCII word character (after any backslashes) or whitespace
+    ASCII_START = re.compile(r'\\*\w|\s', flags=re.ASCII)
+
     def __init__(self, singles, puncs, punc_frac_low, punc_frac_high,
                  valid_count, valid_ratio, stopwords):
         self.singles = singles
@@ -25,6 +49,33 @@ class TextPreprocessor(object):
         self.valid_count = valid_count
         self.valid_ratio = valid_ratio
         self.stopwords = stopwords
+        # only single characters can ever match a character of the text
+        self.single_chars = frozenset(c for c in singles if len(c) == 1)
+        self.punc_chars = frozenset(c for c in puncs if len(c) == 1)
+
+    def punc_ratio(self, text):
+        return sum(text.count(c) for c in self.punc_chars) / len(text)
+
+    def filter_tokens(self, words):
+        '''
+        Drops single characters, tokens starting with ASCII word
+        characters or whitespace, stopwords, tokens containing any of
+        the single characters and tokens with heavy character repetition
+        '''
+        ascii_start = self.ASCII_START.match
+        stopwords, singles = self.stopwords, self.single_chars
+        word_list = []
+        for word in words:
+            n = len(word)
+            if n == 1 \
+                    or word in stopwords \
+                    or ascii_start(word) \
+                    or not singles.isdisjoint(word) \
+                    or n > 2*len(set(word)):
+                continue
+            word_list.append(word)
+
+        return word_list
 
     def preprocess(self, text):
         '''
@@ -32,29 +83,15 @@ class TextPreprocessor(object):
         Args:
         text: text to be tokenized
         '''
-        cnt = 0
-        for c in text:
-            if c in self.puncs:
-                cnt += 1
+        if len(text) == 0:
+            return []
 
-        ratio = cnt / len(text)
+        ratio = self.punc_ratio(text)
 
         if ratio < self.punc_frac_low or ratio > self.punc_frac_high:
             return []
 
-        alphanum, whitespace = r'\\*\w+', r'\s'
-        word_list = []
-        words = jieba.cut(text, cut_all=False)
-
-        for word in words:
-            if len(word) == 1 \
-                    or re.match(alphanum, word, flags=re.ASCII) \
-                    or re.match(whitespace, word, flags=re.ASCII) \
-                    or word in self.stopwords \
-                    or any(c in self.singles for c in word) \
-                    or len(word) / len(set(word)) > 2:
-                continue
-            word_list.append(word)
+        word_list = self.filter_tokens(jieba.cut(text, cut_all=False))
 
         if len(word_list) < self.valid_count \
                 or len(word_list) / len(set(word_list)) > self.valid_ratio: \
@@ -63,6 +100,282 @@ class TextPreprocessor(object):
         return word_list
 
 
+_worker_preprocessor = None
+
+
+def _init_preprocessing_worker(preprocessor_args):
+    global _worker_preprocessor
+    jieba.initialize()
+    _worker_preprocessor = TextPreprocessor(**preprocessor_args)
+
+
+def _preprocess_in_worker(text):
+    return _worker_preprocessor.preprocess(text)
+
+
+class _Done(object):
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+
+class ParallelPreprocessor(object):
+    '''
+    Tokenizes documents in a pool of worker processes, each holding its
+    own TextPreprocessor with the jieba dictionary loaded once, so that
+    tokenization of incoming messages overlaps with scoring. Documents
+    are submitted as they arrive and their results collected in the
+    same order. Runs in the calling process if num_workers is 0. May be
+    shared by threads, the pool takes documents from any of them
+    '''
+    def __init__(self, num_workers, **preprocessor_args):
+        if num_workers > 0:
+            self.pool = multiprocessing.Pool(num_workers,
+                                             initializer=_init_preprocessing_worker,
+                                             initargs=(preprocessor_args,))
+            self.preprocessor = None
+        else:
+            self.pool = None
+            self.preprocessor = TextPreprocessor(**preprocessor_args)
+        self.submitted = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.count_lock = threading.Lock()
+
+    @property
+    def depth(self):
+        '''
+        Number of documents submitted whose results are not collected yet
+        '''
+        return self.submitted - self.completed
+
+    def submit(self, text):
+        with self.count_lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        if self.pool is None or len(text) == 0:
+            return _Done(self.preprocessor.preprocess(text) if self.pool is None else [])
+        return self.pool.apply_async(_preprocess_in_worker, (text,))
+
+    def get(self, result):
+        content = result.get()
+        with self.count_lock:
+            self.completed += 1
+        return content
+
+    def preprocess(self, text):
+        return self.get(self.submit(text))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class WriteAheadLog(object):
+    '''
+    Append-only log of corpus mutations, one JSON record per line, kept
+    in numbered segment files under log_dir. Records are appended before
+    a mutation is applied and made durable by sync() before the message
+    that caused it is acknowledged. Opening the log starts a new segment;
+    the older ones are the tail to replay on top of the last snapshot.
+    rotate() starts a new segment on every save, and discard() removes
+    the segments a snapshot has made obsolete
+    '''
+    def __init__(self, log_dir, logger):
+        self.log_dir = log_dir
+        self.logger = logger
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self.segments = sorted(int(os.path.basename(path)) for path in
+                               glob.glob(os.path.join(log_dir, '[0-9]*')))
+        self.current = self.segments[-1] + 1 if self.segments else 0
+        self.file = None
+        self._open()
+
+    def _path(self, segment):
+        return os.path.join(self.log_dir, '{:010d}'.format(segment))
+
+    def _open(self):
+        self.file = open(self._path(self.current), 'ab')
+        self.segments.append(self.current)
+        self.num_unsynced = 0
+
+    def append(self, op, **fields):
+        fields['op'] = op
+        self.file.write(json.dumps(fields).encode('utf-8') + b'\n')
+        self.num_unsynced += 1
+
+    def sync(self):
+        '''
+        Flushes the appended records to disk with a single fsync
+        '''
+        if self.num_unsynced == 0:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.num_unsynced = 0
+
+    def replay(self, start=0, stop=None):
+        '''
+        Yields the records of the segments from start up to stop, by
+        default the current one, in the order they were written.
+        Segments below start are covered by the snapshot that was loaded
+        and must not be applied twice. A torn record at the end of a
+        segment, left by a crash in the middle of a write, is skipped
+        '''
+        stop = self.current if stop is None else min(stop, self.current)
+        for segment in self.segments:
+            if segment < start:
+                continue
+            if segment >= stop:
+                break
+            with open(self._path(segment), 'rb') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        self.logger.warning('Skipping corrupted record in log segment %d', segment)
+
+    def rotate(self):
+        '''
+        Starts a new segment and returns its number. All segments before
+        it are complete
+        '''
+        self.sync()
+        self.file.close()
+        self.current += 1
+        self._open()
+        return self.current
+
+    def size(self):
+        '''
+        Returns the number of bytes in the log
+        '''
+        self.file.flush()
+        return sum(os.path.getsize(self._path(segment)) for segment in self.segments)
+
+    def discard(self, before):
+        '''
+        Removes the segments numbered below before
+        '''
+        for segment in [seg for seg in self.segments if seg < before]:
+            os.remove(self._path(segment))
+            self.segments.remove(segment)
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class DateIndex(object):
+    '''
+    Columnar index of topic id's kept sorted by date, in parallel id and
+    date arrays between a head and a tail position. Topics arrive almost
+    always in date order and are appended at the tail, and expiring ones
+    are the oldest and leave at the head, so the oldest and latest
+    topics are found in O(1) and the topics before a date are a slice.
+    Topics deleted from the middle leave tombstones, which are reclaimed
+    by compaction once they make up half of the index.
+    '''
+    def __init__(self, capacity=1024):
+        self.ids = np.empty(capacity, dtype=object)
+        self.dates = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.positions = {}  # topic id -> position in the arrays
+        self.head = 0
+        self.tail = 0
+        self.num_dead = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, topic_id):
+        return topic_id in self.positions
+
+    @classmethod
+    def build(cls, topic_ids, dates):
+        index = cls(capacity=max(1024, 2*len(topic_ids)))
+        order = np.argsort(np.asarray(dates, dtype=np.int64), kind='stable')
+        n = len(order)
+        index.ids[:n] = [topic_ids[i] for i in order]
+        index.dates[:n] = np.asarray(dates, dtype=np.int64)[order]
+        index.alive[:n] = True
+        index.positions = {tid: pos for pos, tid in enumerate(index.ids[:n])}
+        index.tail = n
+        return index
+
+    @property
+    def oldest(self):
+        return self.ids[self.head] if self.positions else None
+
+    @property
+    def latest(self):
+        return self.ids[self.tail-1] if self.positions else None
+
+    def add(self, topic_id, date):
+        if topic_id in self.positions:
+            self.delete(topic_id)
+        if self.tail == len(self.ids):
+            self.compact()
+
+        if self.tail == self.head or date >= self.dates[self.tail-1]:
+            pos = self.tail
+        else:
+            # out of order, shift the later topics up by one
+            pos = self.head + int(np.searchsorted(self.dates[self.head:self.tail], date, side='right'))
+            self.ids[pos+1:self.tail+1] = self.ids[pos:self.tail]
+            self.dates[pos+1:self.tail+1] = self.dates[pos:self.tail]
+            self.alive[pos+1:self.tail+1] = self.alive[pos:self.tail]
+            for i in range(pos+1, self.tail+1):
+                if self.alive[i]:
+                    self.positions[self.ids[i]] = i
+
+        self.ids[pos] = topic_id
+        self.dates[pos] = date
+        self.alive[pos] = True
+        self.positions[topic_id] = pos
+        self.tail += 1
+
+    def delete(self, topic_id):
+        pos = self.positions.pop(topic_id, None)
+        if pos is None:
+            return
+
+        self.ids[pos] = None
+        self.alive[pos] = False
+        self.num_dead += 1
+        while self.head < self.tail and not self.alive[self.head]:
+            self.head += 1
+            self.num_dead -= 1
+        while self.tail > self.head and not self.alive[self.tail-1]:
+            self.tail -= 1
+            self.num_dead -= 1
+        if self.num_dead > len(self.positions):
+            self.compact()
+
+    def before(self, t):
+        '''
+        Returns the id's of the topics dated before t, oldest first
+        '''
+        end = self.head + int(np.searchsorted(self.dates[self.head:self.tail], t, side='left'))
+        return self.ids[self.head:end][self.alive[self.head:end]].tolist()
+
+    def compact(self):
+        keep = self.head + np.flatnonzero(self.alive[self.head:self.tail])
+        n = len(keep)
+        capacity = max(1024, 2*n)
+        ids, dates = self.ids[keep], self.dates[keep]
+        self.ids = np.empty(capacity, dtype=object)
+        self.dates = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids[:n], self.dates[:n], self.alive[:n] = ids, dates, True
+        self.positions = {tid: pos for pos, tid in enumerate(ids)}
+        self.head, self.tail, self.num_dead = 0, n, 0
+
+
 class AbstractCorpus(object):
     '''
     Corpus object
@@ -72,6 +385,8 @@ class AbstractCorpus(object):
         self.dictionary = corpora.Dictionary([])
         self.name = name
         self.logger = logger
+        self.deleted = set()  # topics deleted since the last capture of updates
+        self.index = DateIndex()
 
     @property
     def size(self):
@@ -79,15 +394,123 @@ class AbstractCorpus(object):
 
     @property
     def oldest(self):
-        if len(self.data) == 0:
-            return None
-        return min(self.data.keys())
+        return self.index.oldest
 
     @property
     def latest(self):
-        if len(self.data) == 0:
-            return None
-        return max(self.data.keys())
+        return self.index.latest
+
+    def _build_index(self):
+        tids = list(self.data)
+        self.index = DateIndex.build(tids, [self.data[tid]['date'] for tid in tids])
+
+    def get_bow(self, topic_id):
+        '''
+        Returns the cached bag-of-words vector of a topic, computing
+        it from the topic body if it is not cached yet
+        '''
+        data = self.data[topic_id]
+        if data.get('bow') is None:
+            data['bow'] = self.dictionary.doc2bow(data['body'])
+        return data['bow']
+
+    def _build_dictionary(self):
+        '''
+        Builds the dictionary of a loaded corpus from the topic bodies.
+        Saved records hold no bag-of-words vectors, whose token id's
+        would not survive compaction; they are computed on demand
+        '''
+        self.dictionary = corpora.Dictionary([data['body'] for data in self.data.values()])
+
+    def _remove_from_dictionary(self, bow):
+        '''
+        Reverts the document statistics a bag-of-words vector contributed
+        to the dictionary when it was added
+        '''
+        for wid, count in bow:
+            self.dictionary.dfs[wid] -= 1
+            if self.dictionary.dfs[wid] <= 0:
+                del self.dictionary.dfs[wid]
+            if hasattr(self.dictionary, 'cfs') and wid in self.dictionary.cfs:
+                self.dictionary.cfs[wid] -= count
+                if self.dictionary.cfs[wid] <= 0:
+                    del self.dictionary.cfs[wid]
+        self.dictionary.num_docs -= 1
+        self.dictionary.num_pos -= sum(count for _, count in bow)
+        self.dictionary.num_nnz -= len(bow)
+
+    def _dictionary_bytes(self):
+        '''
+        Approximate memory taken by the dictionary's mappings and tokens
+        '''
+        d = self.dictionary
+        return sum(sys.getsizeof(m) for m in (d.token2id, d.id2token, d.dfs, getattr(d, 'cfs', {}))) \
+            + sum(sys.getsizeof(token) for token in d.token2id)
+
+    def compact_dictionary(self, min_unused=0.5):
+        '''
+        Drops the tokens no topic in the corpus contains any more and
+        renumbers the rest, once the unused ones make up min_unused of
+        the dictionary. Renumbering keeps token id's in the same order,
+        so sorted bag-of-words vectors stay sorted
+        Returns whether the dictionary was compacted
+        '''
+        unused = [wid for wid in self.dictionary.token2id.values() if self.dictionary.dfs.get(wid, 0) <= 0]
+        if len(unused) == 0 or len(unused) < min_unused*len(self.dictionary):
+            return False
+
+        num_tokens, num_bytes = len(self.dictionary), self._dictionary_bytes()
+        old_ids = self.dictionary.token2id
+        self.dictionary.filter_tokens(bad_ids=unused)
+        remap = np.full(max(old_ids.values())+1, -1, dtype=np.int32)
+        for token, wid in self.dictionary.token2id.items():
+            remap[old_ids[token]] = wid
+        self._remap_tokens(remap)
+
+        self.logger.info('Dictionary of %s compacted from %d to %d tokens, %.1fMB to %.1fMB',
+                         self.name, num_tokens, len(self.dictionary),
+                         num_bytes/2**20, self._dictionary_bytes()/2**20)
+        return True
+
+    def _remap_tokens(self, remap):
+        '''
+        Renumbers the token id's of the cached bag-of-words vectors
+        through the array remap after the dictionary has been compacted
+        '''
+        for data in self.data.values():
+            if data.get('bow') is not None:
+                data['bow'] = [(int(remap[wid]), count) for wid, count in data['bow']]
+
+    def capture_updates(self):
+        '''
+        Copies the records updated since the last capture, together with
+        the id's of the topics deleted in the meantime, and clears their
+        update flags. Only this step needs to hold the lock guarding the
+        corpus; the copy can then be written with write_updates without it
+        '''
+        records = {}
+        for tid, data in self.data.items():
+            if data['updated']:
+                records[tid] = self._record(tid)
+                data['updated'] = False
+        deleted, self.deleted = self.deleted, set()
+        return records, deleted
+
+    def restore_updates(self, updates):
+        '''
+        Flags the records of a capture as updated again after writing
+        them has failed
+        '''
+        for tid in updates[0]:
+            if tid in self.data:
+                self.data[tid]['updated'] = True
+        self.deleted.update(tid for tid in updates[1] if tid not in self.data)
+
+    def _record(self, topic_id):
+        return NotImplemented
+
+    def write_updates(self, updates, save_dir, num_files_per_folder):
+        return NotImplemented
 
     def add(self, topic_id, content, date):
         return NotImplemented
@@ -104,7 +527,11 @@ class AbstractCorpus(object):
 
 class CorpusTfidf(AbstractCorpus):
     def __init__(self, name, target_corpus, tfidf_scheme, num_keywords,
-                 time_decay, max_recoms, logger):
+                 time_decay, max_recoms, logger, max_overflow=0):
+        '''
+        max_overflow: number of runner-up recommendations kept beyond
+                      max_recoms to take the place of deleted ones
+        '''
         super().__init__(name=name,
                          logger=logger)
         self.target_corpus = target_corpus
@@ -112,48 +539,120 @@ class CorpusTfidf(AbstractCorpus):
         self.num_keywords = num_keywords
         self.time_decay = time_decay
         self.max_recoms = max_recoms
+        self.capacity = max_recoms + max_overflow
+        self.stale = set()  # specials whose recommendations ran short and need rescoring
+        self.wal_segment = 0  # first log segment not reflected in the loaded files
+        # keyword token -> {special topic id: keyword weight}
+        self.keyword_index = defaultdict(dict)
+        # token -> id's of the special topics whose body contains it
+        self.postings = defaultdict(set)
+
+    def _index_keywords(self, topic_id, keywords):
+        old_keywords = self.data[topic_id].get('keywords') or {}
+        for word in old_keywords:
+            self.keyword_index[word].pop(topic_id, None)
+            if len(self.keyword_index[word]) == 0:
+                del self.keyword_index[word]
+        for word, weight in keywords.items():
+            self.keyword_index[word][topic_id] = weight
+
+    def _post(self, topic_id, tokens, remove=False):
+        for word in set(tokens):
+            if not remove:
+                self.postings[word].add(topic_id)
+                continue
+            self.postings[word].discard(topic_id)
+            if len(self.postings[word]) == 0:
+                del self.postings[word]
 
-    def _update_keywords(self):
+    def _tfidf_model(self, token_ids):
+        '''
+        Builds the TFIDF model from the document frequencies the
+        dictionary keeps up to date, computing the idf's of token_ids
+        only. Pivoted normalization depends on the whole vocabulary and
+        gets the full model
+        '''
+        if self.tfidf_scheme[2] in 'ub':
+            return tfidfmodel.TfidfModel(dictionary=self.dictionary, smartirs=self.tfidf_scheme)
+        tfidf = tfidfmodel.TfidfModel(smartirs=self.tfidf_scheme)
+        tfidf.num_docs, tfidf.num_nnz = self.dictionary.num_docs, self.dictionary.num_nnz
+        tfidf.dfs = {wid: self.dictionary.dfs[wid] for wid in token_ids}
+        tfidf.idfs = tfidfmodel.precompute_idfs(tfidf.wglobal, tfidf.dfs, tfidf.num_docs)
+        return tfidf
+
+    def _update_keywords(self, tokens):
         """
-        For each topic in the corpus, generate using TFIDF a list of
-        n_keywords most importance keywords in the form of token-to-weight
-        mapping
-        :param n_keywords: number of keywords to store for each topic
+        For each topic in the corpus containing one of the given tokens,
+        whose document frequencies have changed, generate using TFIDF a
+        list of n_keywords most importance keywords in the form of
+        token-to-weight mapping. The keywords of the other topics only
+        drift with the number of topics in the corpus, they are left as
+        they are until one of their tokens changes.
+        Returns the set of topic id's whose keyword tokens have changed
         """
-        corpus_bow = [self.dictionary.doc2bow(data['body'])
-                      for data in self.data.values()]
-        tfidf = tfidfmodel.TfidfModel(corpus_bow, smartirs=self.tfidf_scheme)
-
-        for tid, data in self.data.items():
-            weights = tfidf[self.dictionary.doc2bow(data['body'])]
+        affected = set()
+        for word in set(tokens):
+            affected.update(self.postings.get(word, ()))
+        tfidf = self._tfidf_model({wid for tid in affected for wid, _ in self.get_bow(tid)})
+        changed = set()
+        for tid in affected:
+            data = self.data[tid]
+            weights = tfidf[self.get_bow(tid)]
             weights.sort(key=lambda x: x[1], reverse=True)
             # generate token-to-weight mapping instead of id-to-weight mapping
-            data['keywords'] = {self.dictionary[wid]: weight
-                                for wid, weight in weights[:self.num_keywords]}
+            keywords = {self.dictionary[wid]: weight
+                        for wid, weight in weights[:self.num_keywords]}
+            if keywords.keys() != data.get('keywords', {}).keys():
+                changed.add(tid)
+                data['updated'] = True
+            self._index_keywords(tid, keywords)
+            data['keywords'] = keywords
+
+        return changed
 
     def add(self, topic_id, content, date):
+        if topic_id in self.data:
+            self.delete(topic_id)
+
+        self.deleted.discard(topic_id)
+        self.dictionary.add_documents([content])
+        self.index.add(topic_id, date)
         self.data[topic_id] = {'date': date,
                                'body': content,
-                               'recommendations': [],
+                               'bow': self.dictionary.doc2bow(content),
+                               'keywords': {},
+                               'recommendations': TopK(self.capacity),
                                'updated': True
                                }
 
-        self.dictionary.add_documents([content])
-        self._generate_recommendations(topic_id, date)
+        self._post(topic_id, content)
+
+        # only specials whose keywords have moved need to be rescored
+        for tid in self._update_keywords(content) | {topic_id}:
+            self._generate_recommendations(tid, self.data[tid]['date'])
         self.logger.info('Special topic %s added to %s (%d)', topic_id, self.name, len(self.data))
 
-    def _generate_recommendations(self, topic_id, date):
-        self._update_keywords()
+    def _clear_recommendations(self, topic_id):
+        for tid, _ in self.data[topic_id]['recommendations']:
+            if tid in self.target_corpus.data:
+                discard(self.target_corpus.data[tid]['appears_in_special'], topic_id)
+        self.data[topic_id]['recommendations'] = TopK(self.capacity)
+
+    def _generate_recommendations(self, topic_id, date, exclude=()):
+        self._clear_recommendations(topic_id)
+        self.data[topic_id]['updated'] = True
         for tid, data in self.target_corpus.data.items():
+            if tid in exclude:
+                continue
             relevance = sum(self.data[topic_id]['keywords'].get(word, 0) for word in data['body'])
             day_delta = (int(date) - int(data['date'])) / NUM_SECONDS_PER_DAY
             relevance *= min(1.0, math.pow(self.time_decay, day_delta))
-            del_id = insert(self.data[topic_id]['recommendations'], tid, relevance, self.max_recoms)
+            del_id = self.data[topic_id]['recommendations'].insert(tid, relevance)
             if del_id is None:
                 continue
             data['appears_in_special'].append(topic_id)
             if del_id != '':
-                remove(data['appears_in_special'], del_id)
+                discard(self.target_corpus.data[del_id]['appears_in_special'], topic_id)
 
     def update_on_new_topic(self, topic_id, content, date):
         """
@@ -162,17 +661,23 @@ class CorpusTfidf(AbstractCorpus):
         if len(content) == 0:
             return
 
-        for tid, data in self.data.items():
-            relevance = sum(data['keywords'].get(word, 0) for word in content)
+        # look up the specials sharing a keyword with the new topic
+        relevances = {}
+        for word in content:
+            for tid, weight in self.keyword_index.get(word, {}).items():
+                relevances[tid] = relevances.get(tid, 0) + weight
+
+        for tid, relevance in relevances.items():
+            data = self.data[tid]
             day_delta = (int(data['date']) - int(date)) / NUM_SECONDS_PER_DAY  # convert to number of days
             relevance *= min(1.0, math.pow(self.time_decay, day_delta))
-            del_id = insert(data['recommendations'], topic_id, relevance, self.max_recoms)
+            del_id = data['recommendations'].insert(topic_id, relevance)
             if del_id is None:  # no insertion performed
                 continue
             self.data[tid]['updated'] = True
             self.target_corpus.data[topic_id]['appears_in_special'].append(tid)
             if del_id != '':
-                remove(self.target_corpus.data[del_id]['appears_in_special'], tid)
+                discard(self.target_corpus.data[del_id]['appears_in_special'], tid)
 
     def update_on_delete_topic(self, topic_id):
         if topic_id not in self.target_corpus.data:
@@ -180,16 +685,83 @@ class CorpusTfidf(AbstractCorpus):
 
         for tid in self.target_corpus.data[topic_id]['appears_in_special']:
             if topic_id in self.data[tid]['recommendations']:
-                remove(self.data[tid]['recommendations'], topic_id)
+                self.data[tid]['recommendations'].remove(topic_id)
+                self.data[tid]['updated'] = True
+                self._check_stale(tid)
+
+    def relink(self):
+        '''
+        Rebuilds the reverse links of the target corpus from the
+        recommendation lists. Topic snapshots leave them out
+        '''
+        for data in self.target_corpus.data.values():
+            data['appears_in_special'] = []
+        for tid, data in self.data.items():
+            for x, _ in data['recommendations']:
+                if x in self.target_corpus.data:
+                    self.target_corpus.data[x]['appears_in_special'].append(tid)
+
+    def _check_stale(self, topic_id):
+        '''
+        Flags a special for rescoring once deletes have used up its
+        runner-ups and other topics may have been turned away
+        '''
+        recoms = self.data[topic_id]['recommendations']
+        if len(recoms) < self.max_recoms and recoms.truncated:
+            self.stale.add(topic_id)
+
+    def refill(self, exclude=()):
+        '''
+        Rescores the specials flagged by _check_stale against the target
+        corpus, leaving out the topics in exclude, and returns how many
+        were rescored
+        '''
+        stale = [tid for tid in self.stale if tid in self.data]
+        for tid in stale:
+            self._generate_recommendations(tid, self.data[tid]['date'], exclude)
+        self.stale.clear()
+        return len(stale)
+
+    def update_on_delete_topics(self, topic_ids, backfill=False):
+        '''
+        Removes a batch of topics about to be deleted from the target
+        corpus from all recommendation lists, visiting each affected
+        list once. Must be called before the topics are deleted there
+        Args:
+        topic_ids: id's of the topics to be deleted
+        backfill:  whether to rescore the lists that have run short right
+                   away instead of leaving them to refill
+        '''
+        topic_ids = {tid for tid in topic_ids if tid in self.target_corpus.data}
+        affected = {tid for topic_id in topic_ids
+                    for tid in self.target_corpus.data[topic_id]['appears_in_special'] if tid in self.data}
+
+        for tid in affected:
+            recoms = self.data[tid]['recommendations']
+            for x in [x for x, _ in recoms if x in topic_ids]:
+                recoms.remove(x)
+            self.data[tid]['updated'] = True
+            self._check_stale(tid)
+
+        if backfill:
+            self.refill(exclude=topic_ids)
 
     def delete(self, topic_id):
         if topic_id not in self.data:
             return
 
-        for tid in self.data[topic_id]['recommendations']:
-            remove(self.target_corpus.data[tid]['appears_in_special'], topic_id)
-
+        self._clear_recommendations(topic_id)
+        self._remove_from_dictionary(self.get_bow(topic_id))
+        self._index_keywords(topic_id, {})
+        content = self.data[topic_id]['body']
+        self._post(topic_id, content, remove=True)
         del self.data[topic_id]
+        self.index.delete(topic_id)
+        self.stale.discard(topic_id)
+        self.deleted.add(topic_id)
+
+        for tid in self._update_keywords(content):
+            self._generate_recommendations(tid, self.data[tid]['date'])
 
         self.logger.info('Topic %s deleted', topic_id)
 
@@ -198,20 +770,65 @@ class CorpusTfidf(AbstractCorpus):
             try:
                 with open(file, 'r') as f:
                     rec = json.load(f)
-                    self.data[file] = {'date': rec['date'],
-                                       'body': rec['body'],
-                                       'keywords': rec['keywords'],
-                                       'recommendations': rec['recommendations'],
-                                       'updated': False
-                                       }
+                    tid = os.path.basename(file)
+                    self.data[tid] = {'date': rec['date'],
+                                      'body': rec['body'],
+                                      'bow': None,
+                                      'keywords': rec['keywords'],
+                                      'recommendations': TopK.from_list(
+                                          rec['recommendations'], self.capacity,
+                                          truncated=len(rec['recommendations']) >= self.max_recoms),
+                                      'updated': False
+                                      }
             except json.JSONDecodeError:
                 self.logger.error('Failed to load special topic %s', file)
+        try:
+            with open(os.path.join(save_dir, 'meta.json'), 'r') as f:
+                self.wal_segment = json.load(f)['wal_segment']
+        except (OSError, ValueError, KeyError):
+            self.wal_segment = 0
 
         self.logger.info('%d special topics loaded from disk', len(self.data))
+        self._build_index()
+
+        self.keyword_index = defaultdict(dict)
+        self.postings = defaultdict(set)
+        for tid, data in self.data.items():
+            for word, weight in data['keywords'].items():
+                self.keyword_index[word][tid] = weight
+            self._post(tid, data['body'])
 
         if len(self.data) > 0:
-            corpus = [data['body'] for data in self.data.values()]
-            self.dictionary = corpora.Dictionary(corpus)
+            self._build_dictionary()
+        self.relink()
+
+    def _record(self, topic_id):
+        data = self.data[topic_id]
+        return {'date': data['date'],
+                'body': data['body'],
+                'keywords': dict(data['keywords']),
+                'recommendations': data['recommendations'].to_list()}
+
+    def write_updates(self, updates, save_dir, num_files_per_folder=None, wal_segment=None):
+        '''
+        Writes records captured by capture_updates to disk, one file per
+        special topic, each replaced atomically. wal_segment is the first
+        write-ahead log segment the files do not reflect, if known
+        '''
+        records, deleted = updates
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        for tid, record in records.items():
+            atomic_write(os.path.join(save_dir, tid), json.dumps(record).encode('utf-8'))
+            self.logger.info('Special topic %s saved on disk', tid)
+
+        for tid in deleted:
+            if os.path.exists(os.path.join(save_dir, tid)):
+                os.remove(os.path.join(save_dir, tid))
+
+        if wal_segment is not None:
+            atomic_write(os.path.join(save_dir, 'meta.json'), json.dumps({'wal_segment': wal_segment}).encode('utf-8'))
 
     def save(self, save_dir, num_files_per_folder=None):
         '''
@@ -220,20 +837,640 @@ class CorpusTfidf(AbstractCorpus):
         save_dir: directory under which to save the data
         num_files_per_folder: maximum number of saved topic files per folder
         '''
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
+        self.write_updates(self.capture_updates(), save_dir, num_files_per_folder)
 
-        for tid, data in self.data.items():
-            if data['updated']:
-                record = {'date': data['date'],
-                          'body': data['body'],
-                          'keywords': data['keywords'],
-                          'recommendations': data['recommendations']}
-                with open(os.path.join(save_dir, tid), 'w') as f:
-                    json.dump(record, f)
-                self.logger.info('Special topic %s saved on disk', tid)
-            else:
-                self.logger.info('No updates for topic %s', tid)
+
+class SimilarityMatrix(object):
+    '''
+    L2-normalized CSR matrix of topic vectors, one row per topic, kept in
+    insertion order so that scans over it visit topics in the same order
+    as the corpus dict. Rows are appended into growable arrays; deleted
+    rows are zeroed and reclaimed by compaction once they make up half
+    of the matrix. Arrays are only ever written past the last row or
+    zeroed on delete; growing and compaction allocate new ones, so that
+    views of the matrix stay valid.
+    '''
+    def __init__(self, capacity=1024, dim=0):
+        '''
+        dim: dimension of the dense embeddings kept along with the rows,
+             0 for none
+        '''
+        self.dense = np.zeros((capacity, dim), dtype=np.float32)
+        self.indptr = np.zeros(capacity+1, dtype=np.int64)
+        self.indices = np.zeros(capacity*16, dtype=np.int32)
+        self.values = np.zeros(capacity*16, dtype=np.float64)
+        self.dates = np.zeros(capacity, dtype=np.float64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids = []
+        self.rows = {}
+        self.num_rows = 0
+        self.num_dead = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, topic_id):
+        return topic_id in self.rows
+
+    @classmethod
+    def from_arrays(cls, topic_ids, indptr, token_ids, counts, dates, dense=None):
+        '''
+        Builds the matrix in one go from ragged bag-of-words arrays with
+        token id's sorted within each row, and optionally the dense
+        embeddings of the rows
+        '''
+        n, nnz = len(topic_ids), int(indptr[-1])
+        m = cls(capacity=max(1024, n), dim=0 if dense is None else dense.shape[1])
+        if dense is not None:
+            m.dense[:n] = dense
+        m.indices = cls._grow(m.indices, nnz)
+        m.values = cls._grow(m.values, nnz)
+
+        row_of = np.repeat(np.arange(n), np.diff(indptr))
+        counts = np.asarray(counts, dtype=np.float64)
+        norms = np.sqrt(np.bincount(row_of, weights=counts*counts, minlength=n))
+        m.indptr[:n+1] = indptr
+        m.indices[:nnz] = token_ids
+        m.values[:nnz] = counts / norms[row_of]
+        m.dates[:n] = dates
+        m.alive[:n] = True
+        m.ids = list(topic_ids)
+        m.rows = {tid: row for row, tid in enumerate(m.ids)}
+        m.num_rows = n
+        return m
+
+    @staticmethod
+    def _grow(arr, size):
+        if size <= len(arr):
+            return arr
+        new_arr = np.zeros((max(size, 2*len(arr)),) + arr.shape[1:], dtype=arr.dtype)
+        new_arr[:len(arr)] = arr
+        return new_arr
+
+    @staticmethod
+    def normalize(bow):
+        '''
+        Converts a bag-of-words list into sorted id and L2-normalized
+        weight arrays
+        '''
+        if len(bow) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+        ids, weights = zip(*sorted(bow))
+        weights = np.array(weights, dtype=np.float64)
+        return np.array(ids, dtype=np.int32), weights / np.sqrt(np.dot(weights, weights))
+
+    def add(self, topic_id, bow, date, vector=None):
+        if topic_id in self.rows:
+            self.delete(topic_id)
+
+        ids, weights = self.normalize(bow)
+        row, start = self.num_rows, self.indptr[self.num_rows]
+        end = start + len(ids)
+
+        self.indptr = self._grow(self.indptr, row+2)
+        self.indices = self._grow(self.indices, end)
+        self.values = self._grow(self.values, end)
+        self.dates = self._grow(self.dates, row+1)
+        self.alive = self._grow(self.alive, row+1)
+        self.dense = self._grow(self.dense, row+1)
+
+        if vector is not None:
+            self.dense[row] = vector
+        self.indices[start:end] = ids
+        self.values[start:end] = weights
+        self.indptr[row+1] = end
+        self.dates[row] = int(date)
+        self.alive[row] = True
+        self.ids.append(topic_id)
+        self.rows[topic_id] = row
+        self.num_rows += 1
+
+    def delete(self, topic_id):
+        row = self.rows.pop(topic_id, None)
+        if row is None:
+            return
+
+        self.values[self.indptr[row]:self.indptr[row+1]] = 0
+        self.dense[row] = 0
+        self.alive[row] = False
+        self.ids[row] = None
+        self.num_dead += 1
+
+        if self.num_dead > 64 and 2*self.num_dead > self.num_rows:
+            self.compact()
+
+    @staticmethod
+    def _replace(arr, head):
+        new_arr = np.zeros_like(arr)
+        new_arr[:len(head)] = head
+        return new_arr
+
+    def compact(self):
+        '''
+        Drops deleted rows, preserving the order of the remaining ones
+        '''
+        keep = np.flatnonzero(self.alive[:self.num_rows])
+        lengths = self.indptr[keep+1] - self.indptr[keep]
+        mask = np.repeat(self.alive[:self.num_rows],
+                         np.diff(self.indptr[:self.num_rows+1]))
+        nnz = self.indptr[self.num_rows]
+
+        self.indices = self._replace(self.indices, self.indices[:nnz][mask])
+        self.values = self._replace(self.values, self.values[:nnz][mask])
+        self.indptr = self._replace(self.indptr, np.concatenate([[0], np.cumsum(lengths)]))
+        self.dates = self._replace(self.dates, self.dates[keep])
+        self.dense = self._replace(self.dense, self.dense[keep])
+        self.alive = self._replace(self.alive, np.ones(len(keep), dtype=bool))
+        self.ids = [self.ids[row] for row in keep]
+        self.rows = {tid: row for row, tid in enumerate(self.ids)}
+        self.num_rows = len(keep)
+        self.num_dead = 0
+
+    def remap_columns(self, remap):
+        '''
+        Renumbers the column (token) id's of every row through the array
+        remap, which must keep them in the same order
+        '''
+        nnz = self.indptr[self.num_rows]
+        self.indices = self._replace(self.indices, remap[self.indices[:nnz]])
+
+    def view(self):
+        '''
+        Returns a read-only copy of the matrix sharing its arrays. Rows
+        added afterwards are not part of it and rows deleted afterwards
+        read as dead in it
+        '''
+        return copy.copy(self)
+
+    def matrix(self, num_cols):
+        nnz = self.indptr[self.num_rows]
+        return sparse.csr_matrix((self.values[:nnz], self.indices[:nnz],
+                                  self.indptr[:self.num_rows+1]),
+                                 shape=(self.num_rows, num_cols))
+
+    def similarities_batch(self, bows, num_cols):
+        '''
+        Computes the cosine similarities between a batch of bag-of-words
+        vectors and every row, returned as a sparse CSC matrix with one
+        column per vector
+        '''
+        indptr, indices, values = [0], [], []
+        for bow in bows:
+            ids, weights = self.normalize(bow)
+            indices.append(ids)
+            values.append(weights)
+            indptr.append(indptr[-1] + len(ids))
+        batch = sparse.csr_matrix((np.concatenate(values), np.concatenate(indices), indptr),
+                                  shape=(len(bows), num_cols))
+        return self.matrix(num_cols).dot(batch.T).tocsc()
+
+    def similarities(self, bow, num_cols, rows=None):
+        '''
+        Computes the cosine similarities between a bag-of-words vector
+        and every row (or only the given rows) with a single sparse
+        matrix-vector product
+        '''
+        ids, weights = self.normalize(bow)
+        vec = np.zeros(num_cols, dtype=np.float64)
+        vec[ids] = weights
+        matrix = self.matrix(num_cols)
+        if rows is not None:
+            matrix = matrix[rows]
+        return matrix.dot(vec)
+
+    def dense_similarities(self, vector, rows=None):
+        '''
+        Computes the cosine similarities between a unit embedding and
+        the embeddings of every row (or only the given rows)
+        '''
+        dense = self.dense[:self.num_rows]
+        if rows is not None:
+            dense = dense[rows]
+        return dense.dot(vector)
+
+    def top_dense_rows(self, vector, num):
+        '''
+        Returns the num rows whose embeddings are closest to a unit
+        embedding, by a brute-force scan of the dense block
+        '''
+        sims = self.dense_similarities(vector)
+        if num >= len(sims):
+            return np.arange(len(sims))
+        return np.argpartition(-sims, num)[:num]
+
+    def pairwise(self, topic_ids, num_cols, dense_weight=0):
+        '''
+        Computes the dense matrix of cosine similarities among the rows
+        of the given topics, blended with the similarities of their
+        embeddings by dense_weight. Topics not in the matrix, e.g. added
+        or deleted after a view was taken, have zero similarities
+        '''
+        rows = np.array([self.rows.get(tid, -1) for tid in topic_ids], dtype=np.int64)
+        valid = (rows >= 0) & (rows < self.num_rows)
+        if not valid.all():
+            sims = np.zeros((len(rows), len(rows)))
+            sims[np.ix_(valid, valid)] = self.pairwise([tid for tid, v in zip(topic_ids, valid) if v],
+                                                       num_cols, dense_weight)
+            return sims
+        # the rows are gathered directly, building the whole matrix to
+        # slice it would cost O(nnz) per call
+        lengths = self.indptr[rows+1] - self.indptr[rows]
+        indptr = np.zeros(len(rows)+1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        pos = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        sub = sparse.csr_matrix((self.values[pos], self.indices[pos], indptr), shape=(len(rows), num_cols))
+        sims = sub.dot(sub.T).toarray()
+        if dense_weight > 0:
+            dense = self.dense[rows]
+            sims = (1-dense_weight)*sims + dense_weight*dense.dot(dense.T)
+        return sims
+
+
+class DenseVectors(object):
+    '''
+    L2-normalized float32 vectors of topics, one row per topic, kept in
+    a growable dense matrix so that the cosine similarities between a
+    vector and every row are a single matrix-vector product. Deleted
+    rows are zeroed and reclaimed by compaction once they make up half
+    of the matrix.
+    '''
+    def __init__(self, dim, capacity=1024):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids = []
+        self.rows = {}
+        self.num_rows = 0
+        self.num_dead = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, topic_id):
+        return topic_id in self.rows
+
+    @classmethod
+    def from_arrays(cls, topic_ids, vectors):
+        n = len(topic_ids)
+        dv = cls(vectors.shape[1], capacity=max(1024, n))
+        dv.vectors[:n] = cls.normalize(vectors)
+        dv.alive[:n] = True
+        dv.ids = list(topic_ids)
+        dv.rows = {tid: row for row, tid in enumerate(dv.ids)}
+        dv.num_rows = n
+        return dv
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def add(self, topic_id, vector):
+        if topic_id in self.rows:
+            self.delete(topic_id)
+        if self.num_rows == len(self.vectors):
+            self.compact()
+
+        row = self.num_rows
+        self.vectors[row] = self.normalize(vector)
+        self.alive[row] = True
+        self.ids.append(topic_id)
+        self.rows[topic_id] = row
+        self.num_rows += 1
+
+    def delete(self, topic_id):
+        row = self.rows.pop(topic_id, None)
+        if row is None:
+            return
+
+        self.vectors[row] = 0
+        self.alive[row] = False
+        self.ids[row] = None
+        self.num_dead += 1
+
+        if self.num_dead > 64 and 2*self.num_dead > self.num_rows:
+            self.compact()
+
+    def compact(self):
+        '''
+        Drops the deleted rows, growing the matrix if it is still full
+        '''
+        keep = np.flatnonzero(self.alive[:self.num_rows])
+        n = len(keep)
+        capacity = max(len(self.vectors), 2*n) if n == len(self.vectors) else len(self.vectors)
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:n] = self.vectors[keep]
+        self.vectors = vectors
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.alive[:n] = True
+        self.ids = [self.ids[row] for row in keep]
+        self.rows = {tid: row for row, tid in enumerate(self.ids)}
+        self.num_rows = n
+        self.num_dead = 0
+
+    def vector(self, topic_id):
+        return self.vectors[self.rows[topic_id]]
+
+    def similarities(self, vector):
+        '''
+        Computes the cosine similarities between a vector and every row,
+        0 for deleted rows
+        '''
+        return self.vectors[:self.num_rows].dot(self.normalize(vector))
+
+
+class SIFEmbedder(object):
+    '''
+    Embeds a tokenized text as the smooth inverse frequency weighted
+    average of its word vectors (Arora et al., 2017): each word is
+    weighted by a / (a + p(w)) for its relative frequency p(w) in the
+    corpus the vectors were trained on, and the projection on the first
+    principal component of the training texts, if one was saved along
+    with the vectors, is removed. Embeddings are unit float32 vectors of
+    fixed size, zero for texts without any known word.
+    '''
+    def __init__(self, vectors_path, a=1e-3):
+        kv = KeyedVectors.load(vectors_path)
+        self.key_to_index = kv.key_to_index
+        self.vectors = kv.vectors.astype(np.float32)
+        self.dim = kv.vector_size
+        counts = np.array([kv.get_vecattr(word, 'count') for word in kv.index_to_key], dtype=np.float64)
+        self.weights = (a / (a + counts / counts.sum())).astype(np.float32)
+        pc_path = vectors_path + '.pc.npy'
+        self.pc = np.load(pc_path).astype(np.float32) if os.path.exists(pc_path) else None
+
+    def embed(self, tokens, remove_pc=True):
+        idx = [self.key_to_index[word] for word in tokens if word in self.key_to_index]
+        if len(idx) == 0:
+            return np.zeros(self.dim, dtype=np.float32)
+
+        vector = self.weights[idx].dot(self.vectors[idx]) / len(idx)
+        if remove_pc and self.pc is not None:
+            vector -= self.pc * self.pc.dot(vector)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class CorpusVersion(object):
+    '''
+    Read-only version of the vectors of a CorpusSimilarity, published by
+    the writer after each mutation so that queries run against it
+    without taking the writer's lock (read-copy-update). Publishing is
+    O(1): the version holds a view of the matrix and the token mapping
+    of the dictionary at the time, and the writer replaces rather than
+    modifies anything a version refers to. The one exception is that
+    topics deleted after publication read as dead, so that a version
+    never returns them
+    '''
+    def __init__(self, generation, matrix, token2id, num_cols, embedder=None, embedding_weight=0):
+        self.generation = generation
+        self.matrix = matrix
+        self.token2id = token2id
+        self.num_cols = num_cols
+        self.embedder = embedder
+        self.embedding_weight = embedding_weight
+
+    def __len__(self):
+        return int(self.matrix.alive[:self.matrix.num_rows].sum())
+
+    def doc2bow(self, tokens):
+        '''
+        Converts tokens to a bag-of-words vector over the version's
+        vocabulary, ignoring tokens added to the dictionary since
+        '''
+        counts = defaultdict(int)
+        for token in tokens:
+            token_id = self.token2id.get(token)
+            if token_id is not None and token_id < self.num_cols:
+                counts[token_id] += 1
+        return sorted(counts.items())
+
+    def similarities(self, tokens):
+        '''
+        Computes the similarities between tokenized text and every row,
+        blending in the embedding similarities as the corpus does
+        '''
+        sims = self.matrix.similarities(self.doc2bow(tokens), self.num_cols)
+        if self.embedding_weight > 0:
+            sims = (1-self.embedding_weight)*sims \
+                + self.embedding_weight*self.matrix.dense_similarities(self.embedder.embed(tokens))
+        return sims
+
+    def most_similar(self, tokens, num, irrelevant_thresh, duplicate_thresh, exclude=None):
+        '''
+        Returns up to num [topic_id, similarity]'s of the live topics
+        other than exclude most similar to tokenized text within the
+        relevance thresholds, in descending order of similarity
+        '''
+        sims = self.similarities(tokens)
+        valid = (sims >= irrelevant_thresh) & (sims <= duplicate_thresh) \
+            & self.matrix.alive[:self.matrix.num_rows]
+        rows = np.flatnonzero(valid)
+        rows = rows[np.argsort(-sims[rows], kind='stable')]
+
+        result = []
+        for row in rows:
+            topic_id = self.matrix.ids[row]
+            if topic_id is not None and topic_id != exclude:  # None if deleted since the alive check
+                result.append([topic_id, float(sims[row])])
+                if len(result) == num:
+                    break
+        return result
+
+
+def _time_decayed(sims, date, dates, alive, time_decay, irrelevant_thresh, duplicate_thresh):
+    '''
+    Applies the time decay to the cosine similarities between a topic
+    posted at date and topics posted at dates, in both directions, and
+    flags the live ones within the relevance thresholds
+    '''
+    day_delta = (int(date) - dates) / NUM_SECONDS_PER_DAY
+    time_factor = np.power(time_decay, day_delta)
+    sims_1 = sims * np.minimum(1.0, 1/time_factor)
+    sims_2 = sims * np.minimum(1.0, time_factor)
+
+    valid_1 = (sims_1 >= irrelevant_thresh) & (sims_1 <= duplicate_thresh) & alive
+    valid_2 = (sims_2 >= irrelevant_thresh) & (sims_2 <= duplicate_thresh) & alive
+
+    return sims_1, sims_2, valid_1, valid_2
+
+
+def _score_shard(matrix, bows, vectors, dates, num_cols, embedding_weight, thresholds):
+    sims = matrix.similarities_batch(bows, num_cols)
+    if embedding_weight > 0:
+        dense = matrix.dense_similarities(np.stack(vectors).T)
+
+    results = []
+    for j, date in enumerate(dates):
+        if embedding_weight > 0:
+            rows = np.arange(matrix.num_rows)
+            col = (1-embedding_weight)*sims[:, j].toarray().ravel() + embedding_weight*dense[:, j]
+        else:
+            start, end = sims.indptr[j], sims.indptr[j+1]
+            rows, col = sims.indices[start:end], sims.data[start:end]
+        sims_1, sims_2, valid_1, valid_2 = _time_decayed(col, date, matrix.dates[rows],
+                                                         matrix.alive[rows], *thresholds)
+        keep = valid_1 | valid_2
+        results.append(([matrix.ids[row] for row in rows[keep]],
+                        sims_1[keep], sims_2[keep], valid_1[keep], valid_2[keep]))
+
+    return results
+
+
+def _run_shard(conn, dim, embedding_weight, thresholds):
+    matrix = SimilarityMatrix(dim=dim)
+    while True:
+        op, args = conn.recv()
+        if op == 'add':
+            for topic_id, bow, date, vector in args:
+                matrix.add(topic_id, bow, date, vector)
+        elif op == 'delete':
+            for topic_id in args:
+                matrix.delete(topic_id)
+        elif op == 'clear':
+            matrix = SimilarityMatrix(dim=dim)
+        elif op == 'score':
+            conn.send(_score_shard(matrix, *args, embedding_weight, thresholds))
+        elif op == 'close':
+            return
+
+
+class MatrixShards(object):
+    '''
+    Copy of a SimilarityMatrix partitioned by topic id hash across worker
+    processes. A batch of topics is scored against every shard at once,
+    so the sparse products run on as many cores as there are shards, and
+    each shard only sends back the topics within the relevance
+    thresholds, which are concatenated per scored topic. Messages to a
+    shard are processed in order, so a shard always reflects every add
+    and delete sent before a score
+    '''
+    def __init__(self, num_shards, dim, embedding_weight, time_decay,
+                 irrelevant_thresh, duplicate_thresh):
+        self.conns, self.workers = [], []
+        thresholds = (time_decay, irrelevant_thresh, duplicate_thresh)
+        for _ in range(num_shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_run_shard,
+                                             args=(worker_conn, dim, embedding_weight, thresholds),
+                                             daemon=True)
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def __len__(self):
+        return len(self.conns)
+
+    def _owner(self, topic_id):
+        return zlib.crc32(str(topic_id).encode()) % len(self.conns)
+
+    def _route(self, op, items, key):
+        parts = defaultdict(list)
+        for item in items:
+            parts[self._owner(key(item))].append(item)
+        for shard, part in parts.items():
+            self.conns[shard].send((op, part))
+
+    def add(self, records):
+        '''
+        Adds (topic_id, bow, date, vector)'s to their shards
+        '''
+        self._route('add', records, lambda record: record[0])
+
+    def delete(self, topic_ids):
+        self._route('delete', topic_ids, lambda topic_id: topic_id)
+
+    def load(self, records):
+        '''
+        Replaces the contents of every shard with the given records
+        '''
+        for conn in self.conns:
+            conn.send(('clear', None))
+        self.add(records)
+
+    def score(self, bows, vectors, dates, num_cols):
+        '''
+        Scores a batch of bag-of-words vectors (and embeddings, if any)
+        posted at dates against every shard
+        Returns:
+        list of (topic ids, sims_1, sims_2, valid_1, valid_2) per vector,
+        covering the topics within the relevance thresholds in either
+        direction
+        '''
+        for conn in self.conns:
+            conn.send(('score', (bows, vectors, dates, num_cols)))
+        partials = [conn.recv() for conn in self.conns]
+
+        return [(list(chain.from_iterable(part[j][0] for part in partials)),)
+                + tuple(np.concatenate([part[j][k] for part in partials]) for k in range(1, 5))
+                for j in range(len(bows))]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for worker in self.workers:
+            worker.join()
+
+
+class MinHashLSH(object):
+    '''
+    Locality sensitive hashing index over the token sets of topics.
+    Each topic gets a MinHash signature of num_perm universal hashes of
+    its token id's, which is cut into num_bands bands; topics sharing
+    any band land in the same bucket and are returned as candidates
+    for each other. Pairs with Jaccard similarity s become candidates
+    with probability 1 - (1 - s^r)^b for r rows per band and b bands.
+    '''
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, num_perm, num_bands, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, self.PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, self.PRIME, size=num_perm).astype(np.uint64)
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.buckets = [defaultdict(set) for _ in range(num_bands)]
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _band_keys(self, token_ids):
+        ids = np.asarray(token_ids, dtype=np.uint64)
+        sig = ((np.outer(self.a, ids) + self.b[:, None]) % self.PRIME).min(axis=1)
+        r = self.rows_per_band
+        return [sig[i*r:(i+1)*r].tobytes() for i in range(self.num_bands)]
+
+    def add(self, topic_id, token_ids):
+        if len(token_ids) == 0:
+            return
+        self.delete(topic_id)
+        keys = self._band_keys(token_ids)
+        for bucket, key in zip(self.buckets, keys):
+            bucket[key].add(topic_id)
+        self.keys[topic_id] = keys
+
+    def delete(self, topic_id):
+        keys = self.keys.pop(topic_id, None)
+        if keys is None:
+            return
+        for bucket, key in zip(self.buckets, keys):
+            bucket[key].discard(topic_id)
+            if len(bucket[key]) == 0:
+                del bucket[key]
+
+    def query(self, token_ids):
+        '''
+        Returns the set of topic id's sharing at least one band with
+        the given token id's
+        '''
+        candidates = set()
+        if len(token_ids) == 0:
+            return candidates
+        for bucket, key in zip(self.buckets, self._band_keys(token_ids)):
+            candidates.update(bucket.get(key, ()))
+        return candidates
 
 
 class CorpusSimilarity(AbstractCorpus):
@@ -241,118 +1478,651 @@ class CorpusSimilarity(AbstractCorpus):
     Corpus collection
     '''
     def __init__(self, name, time_decay, duplicate_thresh,
-                 irrelevant_thresh, max_recoms, logger):
+                 irrelevant_thresh, max_recoms, logger, max_overflow=0,
+                 lsh_num_perm=0, lsh_num_bands=1, lsh_recall_sample=0,
+                 embedder=None, embedding_weight=0, embedding_candidates=100,
+                 num_shards=0):
+        '''
+        max_overflow: number of runner-up topics kept beyond max_recoms
+                      in each similarity list to take the place of
+                      deleted ones
+        lsh_num_perm: number of MinHash permutations used for candidate
+                      generation, 0 to score new topics against the
+                      whole corpus
+        lsh_num_bands: number of LSH bands the signatures are cut into
+        lsh_recall_sample: compare the candidates with exact scoring
+                           every lsh_recall_sample topics, 0 to disable
+        embedder: SIFEmbedder giving each topic a dense embedding, None
+                  to score by bag-of-words cosine similarity only
+        embedding_weight: weight of the embedding similarity in the
+                          blended score
+        embedding_candidates: number of nearest topics by embedding
+                              added to the LSH candidates
+        num_shards: number of worker processes new topics are scored in,
+                    0 to score in the calling process. Not used with
+                    LSH candidate generation
+        '''
         super().__init__(name=name,
                          logger=logger)
         self.time_decay = time_decay
         self.duplicate_thresh = duplicate_thresh
         self.irrelevant_thresh = irrelevant_thresh
         self.max_recoms = max_recoms
+        self.capacity = max_recoms + max_overflow
+        self.stale = set()  # topics whose similarity lists ran short and need rescoring
+        self.embedder = embedder
+        self.embedding_weight = embedding_weight if embedder is not None else 0
+        self.embedding_candidates = embedding_candidates
+        self.matrix = SimilarityMatrix(dim=self._embedding_dim())
+        self.lsh_num_perm = lsh_num_perm
+        self.lsh_num_bands = lsh_num_bands
+        self.lsh = MinHashLSH(lsh_num_perm, lsh_num_bands) if lsh_num_perm > 0 else None
+        self.lsh_recall_sample = lsh_recall_sample
+        self.lsh_recall = [0, 0]  # [exact matches found by LSH, exact matches]
+        self.num_added = 0
+        self.shards = None
+        if num_shards > 0 and self.lsh is None:
+            self.shards = MatrixShards(num_shards, self._embedding_dim(), self.embedding_weight,
+                                       time_decay, irrelevant_thresh, duplicate_thresh)
+        self.generation = 0
+        self.wal_segment = 0  # first log segment not covered by the loaded snapshot
+        self._publish()
+
+    def _publish(self):
+        """
+        Publishes the current state of the matrix for lock-free readers
+        """
+        self.generation += 1
+        self.published = CorpusVersion(self.generation, self.matrix.view(), self.dictionary.token2id,
+                                       len(self.dictionary), self.embedder, self.embedding_weight)
+
+    def _score(self, topic_id, date, rows=None, sims=None):
+        """
+        Computes the time-decayed similarities between a topic and the
+        given matrix rows (all rows if None) in both directions and
+        flags the ones within the relevance thresholds. The raw cosine
+        similarities with the rows may be passed in if already known
+        """
+        if rows is None:
+            rows = np.arange(self.matrix.num_rows)
+        if sims is None:
+            sims = self.matrix.similarities(self.get_bow(topic_id), len(self.dictionary), rows)
+            if self.embedding_weight > 0:
+                sims = self._blend(sims, self.matrix.dense_similarities(self._embedding(topic_id), rows))
+
+        return (rows,) + _time_decayed(sims, date, self.matrix.dates[rows], self.matrix.alive[rows],
+                                       self.time_decay, self.irrelevant_thresh, self.duplicate_thresh)
+
+    def _score_batch(self, topic_ids):
+        """
+        Scores a batch of topics in the corpus against the whole matrix,
+        in one sparse matrix product or across the shards, and returns
+        the output of _score for each of them with the rows in order
+        """
+        vectors = [self._embedding(tid) for tid in topic_ids] if self.embedding_weight > 0 else None
+        if self.shards is not None:
+            return [self._gather(*result) for result in
+                    self.shards.score([self.get_bow(tid) for tid in topic_ids], vectors,
+                                      [self.data[tid]['date'] for tid in topic_ids], len(self.dictionary))]
+
+        sims = self.matrix.similarities_batch([self.get_bow(tid) for tid in topic_ids], len(self.dictionary))
+        if self.embedding_weight > 0:
+            # embeddings make every pair a candidate, so score densely
+            dense = self.matrix.dense_similarities(np.stack(vectors).T)
+        results = []
+        for j, topic_id in enumerate(topic_ids):
+            if self.embedding_weight > 0:
+                rows = np.arange(self.matrix.num_rows)
+                col = self._blend(sims[:, j].toarray().ravel(), dense[:, j])
+            else:
+                start, end = sims.indptr[j], sims.indptr[j+1]
+                order = np.argsort(sims.indices[start:end])
+                rows, col = sims.indices[start:end][order], sims.data[start:end][order]
+            results.append(self._score(topic_id, self.data[topic_id]['date'], rows, col))
+
+        return results
+
+    def _gather(self, topic_ids, sims_1, sims_2, valid_1, valid_2):
+        """
+        Puts the results of scoring across the shards in matrix row order
+        """
+        rows = np.array([self.matrix.rows[tid] for tid in topic_ids], dtype=np.int64)
+        order = np.argsort(rows)
+        return rows[order], sims_1[order], sims_2[order], valid_1[order], valid_2[order]
+
+    def _embedding_dim(self):
+        return self.embedder.dim if self.embedder is not None else 0
+
+    def _embed(self, content):
+        return self.embedder.embed(content) if self.embedder is not None else None
+
+    def _embedding(self, topic_id):
+        return self.matrix.dense[self.matrix.rows[topic_id]]
+
+    def _blend(self, sims, dense_sims):
+        '''
+        Blends bag-of-words and embedding cosine similarities
+        '''
+        return (1-self.embedding_weight)*sims + self.embedding_weight*dense_sims
+
+    def _candidate_rows(self, topic_id):
+        """
+        Returns the sorted matrix rows of the LSH candidates for a topic,
+        together with its nearest topics by embedding, or None if LSH
+        candidate generation is disabled
+        """
+        if self.lsh is None:
+            return None
+
+        token_ids = [wid for wid, _ in self.get_bow(topic_id)]
+        candidates = self.lsh.query(token_ids)
+        self.lsh.add(topic_id, token_ids)
+        rows = {self.matrix.rows[tid] for tid in candidates if tid in self.matrix.rows}
+        if self.embedding_weight > 0:
+            # topics sharing few or no tokens are only found by embedding
+            rows.update(self.matrix.top_dense_rows(self._embedding(topic_id), self.embedding_candidates).tolist())
+        rows = np.array(sorted(rows), dtype=np.int64)
+
+        self.num_added += 1
+        if self.lsh_recall_sample > 0 and self.num_added % self.lsh_recall_sample == 0:
+            self._report_recall(topic_id, rows)
+
+        return rows
 
     def _update_pairwise_similarity(self, topic_id, content, date):
         """
         updates similarity data within the corpus
         """
-        bow = self.dictionary.doc2bow(content)
-        for tid, data in self.data.items():
-            day_delta = (int(date) - int(data['date'])) / NUM_SECONDS_PER_DAY
-            time_factor = math.pow(self.time_decay, day_delta)
+        if self.shards is not None:
+            self._link(topic_id, *self._score_batch([topic_id])[0])
+        else:
+            self._link(topic_id, *self._score(topic_id, date, self._candidate_rows(topic_id)))
+
+    def _link(self, topic_id, rows, sims_1, sims_2, valid_1, valid_2):
+        """
+        Inserts the scored pairs into the similarity lists on both sides
+        and keeps the reverse links in sync
+        """
+        for i in np.flatnonzero(valid_1 | valid_2):
+            tid = self.matrix.ids[rows[i]]
             if tid == topic_id:
                 continue
-            bow1 = self.dictionary.doc2bow(data['body'])
-            sim = matutils.cossim(bow, bow1)
-            sim_1 = sim * min(1.0, 1/time_factor)
-            sim_2 = sim * min(1.0, time_factor)
+            data = self.data[tid]
 
-            if self.irrelevant_thresh <= sim_1 <= self.duplicate_thresh:
-                del_id = insert(data['sim_list'], topic_id, sim_1, self.max_recoms)
+            if valid_1[i]:
+                del_id = data['sim_list'].insert(topic_id, float(sims_1[i]))
                 if del_id is not None:
                     self.data[topic_id]['appears_in'].append(tid)
                     self.data[tid]['updated'] = True
                     if del_id != '':
-                        remove(self.data[del_id]['appears_in'], tid)
+                        discard(self.data[del_id]['appears_in'], tid)
 
-            if self.irrelevant_thresh <= sim_2 <= self.duplicate_thresh:
-                del_id = insert(self.data[topic_id]['sim_list'], tid, sim_2, self.max_recoms)
+            if valid_2[i]:
+                del_id = self.data[topic_id]['sim_list'].insert(tid, float(sims_2[i]))
                 if del_id is not None:
                     self.data[tid]['appears_in'].append(topic_id)
                     if del_id != '':
-                        remove(self.data[del_id]['appears_in'], topic_id)
-
-    def add(self, topic_id, content, date):
-        if len(content) == 0:
-            self.logger.info('Topic %s is not recommendable', topic_id)
-            return
+                        discard(self.data[del_id]['appears_in'], topic_id)
 
+    def _report_recall(self, topic_id, candidate_rows):
+        """
+        Logs the fraction of the topics within the relevance thresholds
+        under exact scoring that LSH returned as candidates
+        """
+        date = self.data[topic_id]['date']
+        rows, _, _, valid_1, valid_2 = self._score(topic_id, date)
+        exact = set(rows[valid_1 | valid_2]) - {self.matrix.rows[topic_id]}
+        found = len(exact.intersection(candidate_rows))
+        self.lsh_recall[0] += found
+        self.lsh_recall[1] += len(exact)
+        self.logger.info('LSH recall for topic %s: %d/%d (cumulative %.4f, %d candidates for %d topics)',
+                         topic_id, found, len(exact),
+                         self.lsh_recall[0] / max(1, self.lsh_recall[1]),
+                         len(candidate_rows), len(self.matrix))
+
+    def _add_record(self, topic_id, content, date):
+        self.deleted.discard(topic_id)
         self.dictionary.add_documents([content])
+        self.index.add(topic_id, date)
 
         self.data[topic_id] = {'date': date,
                                'body': content,
-                               'sim_list': [],
+                               'bow': self.dictionary.doc2bow(content),
+                               'sim_list': TopK(self.capacity),
                                'appears_in': [],
                                'appears_in_special': [],
                                'updated': True}
 
+        vector = self._embed(content)
+        self.matrix.add(topic_id, self.get_bow(topic_id), date, vector)
+        if self.shards is not None:
+            self.shards.add([(topic_id, self.get_bow(topic_id), date, vector)])
+        self._publish()
+
+    def add(self, topic_id, content, date):
+        if len(content) == 0:
+            self.logger.info('Topic %s is not recommendable', topic_id)
+            return
+
+        self._add_record(topic_id, content, date)
         self._update_pairwise_similarity(topic_id, content, date)
 
         self.logger.info('Topic %s added to %s (%d)', topic_id, self.name, len(self.data))
 
+    def add_batch(self, topics):
+        """
+        Adds a batch of (topic_id, content, date)'s, computing the
+        similarities of all of them with the corpus in one sparse
+        matrix product. Each topic is only linked with the topics that
+        precede it, including earlier ones in the same batch, so the
+        result is the same as adding the topics one by one
+        """
+        batch = []
+        for topic_id, content, date in topics:
+            if len(content) == 0:
+                self.logger.info('Topic %s is not recommendable', topic_id)
+            else:
+                batch.append((topic_id, content, date))
+
+        if len(batch) == 0:
+            return
+
+        topic_ids = [topic_id for topic_id, _, _ in batch]
+        if self.lsh is not None or len(set(topic_ids)) < len(topic_ids) \
+                or any(topic_id in self.data for topic_id in topic_ids):
+            for topic_id, content, date in batch:
+                self.add(topic_id, content, date)
+            return
+
+        for topic_id, content, date in batch:
+            self._add_record(topic_id, content, date)
+
+        for topic_id, scored in zip(topic_ids, self._score_batch(topic_ids)):
+            preceding = scored[0] < self.matrix.rows[topic_id]
+            self._link(topic_id, *(arr[preceding] for arr in scored))
+            self.logger.info('Topic %s added to %s (%d)', topic_id, self.name, len(self.data))
+
     def delete(self, topic_id):
         if topic_id not in self.data:
             return
 
         for tid in self.data[topic_id]['appears_in']:  # list of topic id's whose similarity lists tid appears in
             if tid in self.data:
-                remove(self.data[tid]['sim_list'], topic_id)
+                self.data[tid]['sim_list'].remove(topic_id)
                 self.data[tid]['updated'] = True
+                self._check_stale(tid)
 
+        for tid, _ in self.data[topic_id]['sim_list']:
+            if tid in self.data:
+                discard(self.data[tid]['appears_in'], topic_id)
+
+        self._remove_from_dictionary(self.get_bow(topic_id))
         del self.data[topic_id]
+        self.deleted.add(topic_id)
+        self.stale.discard(topic_id)
+        self.index.delete(topic_id)
+        self.matrix.delete(topic_id)
+        if self.lsh is not None:
+            self.lsh.delete(topic_id)
+        if self.shards is not None:
+            self.shards.delete([topic_id])
+        self._publish()
         self.logger.info('Topic %s deleted (%d)', topic_id, len(self.data))
 
-    def remove_before(self, t):
-        for tid in list(self.data.keys()):
-            if self.data[tid]['date'] < t:
-                self.delete(tid)
+    def delete_many(self, topic_ids, backfill=False):
+        '''
+        Deletes a batch of topics, visiting each similarity list and
+        reverse link list that refers to them once instead of once per
+        deleted topic
+        Args:
+        topic_ids: id's of the topics to delete
+        backfill:  whether to rescore the similarity lists that have run
+                   short right away instead of leaving them to refill
+        '''
+        topic_ids = {tid for tid in topic_ids if tid in self.data}
+        if len(topic_ids) == 0:
+            return
+
+        affected = {tid for topic_id in topic_ids for tid in self.data[topic_id]['appears_in']
+                    if tid in self.data and tid not in topic_ids}
+        linked = {tid for topic_id in topic_ids for tid, _ in self.data[topic_id]['sim_list']
+                  if tid in self.data and tid not in topic_ids}
+
+        for tid in affected:
+            sim_list = self.data[tid]['sim_list']
+            for x in [x for x, _ in sim_list if x in topic_ids]:
+                sim_list.remove(x)
+            self.data[tid]['updated'] = True
+
+        for tid in linked:
+            data = self.data[tid]
+            data['appears_in'] = [x for x in data['appears_in'] if x not in topic_ids]
+
+        for topic_id in topic_ids:
+            self._remove_from_dictionary(self.get_bow(topic_id))
+            del self.data[topic_id]
+            self.deleted.add(topic_id)
+            self.stale.discard(topic_id)
+            self.index.delete(topic_id)
+            self.matrix.delete(topic_id)
+            if self.lsh is not None:
+                self.lsh.delete(topic_id)
+        if self.shards is not None:
+            self.shards.delete(topic_ids)
+        self._publish()
+
+        for tid in affected:
+            self._check_stale(tid)
+        if backfill:
+            self.refill()
+
+        self.logger.info('%d topics deleted (%d), %d similarity lists affected',
+                         len(topic_ids), len(self.data), len(affected))
+
+    def _check_stale(self, topic_id):
+        '''
+        Flags a topic for rescoring once deletes have used up the
+        runner-ups in its similarity list and other topics may have
+        been turned away
+        '''
+        sim_list = self.data[topic_id]['sim_list']
+        if len(sim_list) < self.max_recoms and sim_list.truncated:
+            self.stale.add(topic_id)
+
+    def refill(self):
+        '''
+        Rescores the topics flagged by _check_stale and returns how many
+        were rescored
+        '''
+        stale = [tid for tid in self.stale if tid in self.data]
+        self._backfill(stale)
+        self.stale.clear()
+        return len(stale)
+
+    def _backfill(self, topic_ids):
+        '''
+        Rebuilds the similarity lists of the given topics from scratch,
+        scoring all of them against the corpus in one batch
+        '''
+        topic_ids = list(topic_ids)
+        if len(topic_ids) == 0:
+            return
+
+        for topic_id, (rows, _, sims_2, _, valid_2) in zip(topic_ids, self._score_batch(topic_ids)):
+            data = self.data[topic_id]
+            sim_list = TopK(self.capacity)
+            for i in np.flatnonzero(valid_2):
+                tid = self.matrix.ids[rows[i]]
+                if tid != topic_id:
+                    sim_list.insert(tid, float(sims_2[i]))
+
+            old = {tid for tid, _ in data['sim_list']}
+            new = {tid for tid, _ in sim_list}
+            for tid in old - new:
+                discard(self.data[tid]['appears_in'], topic_id)
+            for tid in new - old:
+                self.data[tid]['appears_in'].append(topic_id)
+            data['sim_list'] = sim_list
+            data['updated'] = True
+
+    def remove_before(self, t, backfill=False):
+        self.delete_many(self.index.before(t), backfill)
+
+    def candidate_similarities(self, sim_lists):
+        '''
+        Computes, for each of the given similarity lists, the cosine
+        similarities among its top max_recoms topics, in order. These
+        let the serving side re-rank a list for diversity without any
+        other similarity data. Only reads the published version, so it
+        needs no lock
+        Args:
+        sim_lists: mapping from topic id to its list of [id, score]'s,
+                   e.g. the records of a capture of updates
+        Returns:
+        dict mapping each topic id to a square array over those topics
+        '''
+        version = self.published
+        return {tid: version.matrix.pairwise([t for t, _ in sim_list[:self.max_recoms]],
+                                             version.num_cols, version.embedding_weight)
+                for tid, sim_list in sim_lists.items()}
 
     def find_most_similar(self, topic):
         """
         Given a topic, compute its similarities with all topics 
         in the corpus and return the top n most similar ones from 
-        the corpus
+        the corpus, leaving out the topic itself if its 'topic_id'
+        is given. Only reads the published version, so it needs
+        no lock
         """
-        sim_list = []
-        bow = self.dictionary.doc2bow(topic['body'])
-
-        for tid, data in self.data.items():
-            bow1 = self.dictionary.doc2bow(data['body'])
-            sim = matutils.cossim(bow, bow1)
-            if self.irrelevant_thresh <= sim <= self.duplicate_thresh:
-                insert(sim_list, tid, sim, self.max_recoms)
-
-        return sim_list
+        return self.published.most_similar(topic['body'], self.max_recoms,
+                                           self.irrelevant_thresh, self.duplicate_thresh,
+                                           exclude=topic.get('topic_id'))
 
     def load(self, save_dir):
         for file in glob.glob(os.path.join(save_dir, '[0-9]*', '[0-9]*')):
             try:
                 with open(file, 'r') as f:
                     rec = json.load(f)
-                    self.data[file] = {'date': rec['date'],
-                                       'body': rec['body'],
-                                       'sim_list': rec['sim_list'],
-                                       'appears_in': rec['appears_in'],
-                                       'appears_in_special': rec['appears_in_special'],
-                                       'updated': False
-                                       }
+                    tid = os.path.basename(file)
+                    self.data[tid] = {'date': rec['date'],
+                                      'body': rec['body'],
+                                      'bow': None,
+                                      'sim_list': TopK.from_list(rec['sim_list'], self.capacity,
+                                                                 truncated=len(rec['sim_list']) >= self.max_recoms),
+                                      'appears_in': rec['appears_in'],
+                                      'appears_in_special': rec['appears_in_special'],
+                                      'updated': False
+                                      }
             except json.JSONDecodeError:
                 self.logger.error('Failed to load topic %s', file)
             except KeyError:
                 self.logger.error('Vital keys missing in topic file %s', file)
 
         self.logger.info('%d topics loaded from disk', len(self.data))
+        self._build_index()
 
         if len(self.data) > 0:
-            corpus = [data['body'] for data in self.data.values()]
-            self.dictionary = corpora.Dictionary(corpus)
+            self._build_dictionary()
+
+        self.matrix = SimilarityMatrix(capacity=max(1024, len(self.data)), dim=self._embedding_dim())
+        for tid, data in self.data.items():
+            self.matrix.add(tid, self.get_bow(tid), data['date'], self._embed(data['body']))
+        self._build_lsh()
+        self._load_shards()
+        self._publish()
+
+    def _remap_tokens(self, remap):
+        super()._remap_tokens(remap)
+        # dead rows may hold tokens that are gone
+        self.matrix.compact()
+        self.matrix.remap_columns(remap)
+        self._build_lsh()
+        self._load_shards()
+        self._publish()
+
+    def _load_shards(self):
+        if self.shards is not None:
+            self.shards.load([(tid, self.get_bow(tid), data['date'], self._embedding(tid))
+                              for tid, data in self.data.items()])
+
+    def _build_lsh(self):
+        if self.lsh is None:
+            return
+        self.lsh = MinHashLSH(self.lsh_num_perm, self.lsh_num_bands)
+        for tid in self.data:
+            self.lsh.add(tid, [wid for wid, _ in self.get_bow(tid)])
+
+    def save_snapshot(self, snapshot_dir, wal_segment=0):
+        '''
+        Saves the whole corpus as a few contiguous arrays: topic id's and
+        dates, plus token id's, bag-of-words vectors and similarity lists
+        as ragged arrays with offset tables, next to a dictionary of the
+        tokens they hold. The snapshot is written to a temporary directory
+        which then replaces the previous one
+        Args:
+        snapshot_dir: directory holding the snapshot
+        wal_segment: first write-ahead log segment the snapshot does not
+                     cover, the log is replayed from there on load
+        '''
+        self.write_snapshot(self.capture_snapshot(), snapshot_dir, wal_segment)
+
+    def capture_snapshot(self):
+        '''
+        Copies what the snapshot holds of every topic, for write_snapshot
+        to pack and write without the lock. Only the arrays of the
+        similarity lists are copied; bodies are never modified in place
+        and are shared
+        '''
+        return {tid: {'date': data['date'],
+                      'body': data['body'],
+                      'sim_ids': data['sim_list'].ids[:],
+                      'sim_keys': data['sim_list'].keys[:]}
+                for tid, data in self.data.items()}
+
+    def write_snapshot(self, snapshot, snapshot_dir, wal_segment=0):
+        '''
+        Packs records captured by capture_snapshot into the arrays of a
+        snapshot and writes them. Reverse links are left out, they are
+        rebuilt from the similarity lists on load
+        '''
+        tids = list(snapshot)
+        records = [snapshot[tid] for tid in tids]
+        arrays = {'ids': np.array([int(tid) for tid in tids], dtype=np.int64),
+                  'dates': np.array([int(rec['date']) for rec in records], dtype=np.int64)}
+        # the snapshot gets a dictionary of its own, built from the
+        # bodies it holds, so that packing it needs nothing from the
+        # corpus and can run without the lock
+        token2id = {}
+        arrays['body_indptr'], arrays['body'] = to_ragged(
+            [[token2id.setdefault(word, len(token2id)) for word in rec['body']] for rec in records], np.int32)
+        # bag-of-words vectors, counting the (topic, token) pairs of
+        # all bodies at once
+        num_tokens = max(len(token2id), 1)
+        topics = np.repeat(np.arange(len(tids), dtype=np.int64), np.diff(arrays['body_indptr']))
+        keys, counts = np.unique(topics*num_tokens + arrays['body'], return_counts=True)
+        arrays['bow_indptr'] = np.searchsorted(keys // num_tokens, np.arange(len(tids)+1))
+        arrays['bow_ids'] = (keys % num_tokens).astype(np.int32)
+        arrays['bow_counts'] = counts.astype(np.int32)
+
+        dictionary = corpora.Dictionary()
+        dictionary.token2id = token2id
+        dictionary.dfs = dict(enumerate(np.bincount(arrays['bow_ids'], minlength=len(token2id)).tolist()))
+        dictionary.cfs = dict(enumerate(np.bincount(arrays['body'], minlength=len(token2id)).tolist()))
+        dictionary.num_docs = len(tids)
+        dictionary.num_pos = len(arrays['body'])
+        dictionary.num_nnz = len(arrays['bow_ids'])
+        arrays['sim_indptr'], arrays['sim_ids'] = to_ragged(
+            [[int(tid) for tid in rec['sim_ids']] for rec in records], np.int64)
+        # the lists keep negated values
+        _, arrays['sim_values'] = to_ragged([rec['sim_keys'] for rec in records], np.float64)
+        np.negative(arrays['sim_values'], out=arrays['sim_values'])
+
+        tmp_dir = snapshot_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+        dictionary.save(os.path.join(tmp_dir, 'dictionary'))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'version': 2, 'name': self.name, 'num_topics': len(tids),
+                       'wal_segment': wal_segment}, f)
+
+        old_dir = snapshot_dir + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(snapshot_dir):
+            os.rename(snapshot_dir, old_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+        self.logger.info('Snapshot of %d topics saved to %s', len(tids), snapshot_dir)
+
+    def load_snapshot(self, snapshot_dir):
+        '''
+        Loads a snapshot written by save_snapshot. The arrays are memory
+        mapped and the similarity matrix is built from them directly.
+        Links from the special topics are left for them to restore, see
+        CorpusTfidf.relink
+        '''
+        def load(name):
+            return np.load(os.path.join(snapshot_dir, name + '.npy'), mmap_mode='r')
+
+        self.dictionary = corpora.Dictionary.load(os.path.join(snapshot_dir, 'dictionary'))
+        tokens = np.empty(max(self.dictionary.keys(), default=-1)+1, dtype=object)
+        for wid, word in self.dictionary.items():
+            tokens[wid] = word
+
+        tids = [str(tid) for tid in load('ids').tolist()]
+        dates = np.array(load('dates'))
+        body_indptr, body = load('body_indptr'), load('body')
+        bow_indptr, bow_ids, bow_counts = np.array(load('bow_indptr')), load('bow_ids'), load('bow_counts')
+        sim_indptr, sim_ids, sim_values = load('sim_indptr'), load('sim_ids'), load('sim_values')
+
+        self.data = {}
+        for i, tid in enumerate(tids):
+            b0, b1 = bow_indptr[i], bow_indptr[i+1]
+            s0, s1 = sim_indptr[i], sim_indptr[i+1]
+            sim_list = list(zip(map(str, sim_ids[s0:s1].tolist()), sim_values[s0:s1].tolist()))
+            self.data[tid] = {'date': int(dates[i]),
+                              'body': tokens[body[body_indptr[i]:body_indptr[i+1]]].tolist(),
+                              'bow': list(zip(bow_ids[b0:b1].tolist(), bow_counts[b0:b1].tolist())),
+                              'sim_list': TopK.from_list(sim_list, self.capacity,
+                                                         truncated=len(sim_list) >= self.max_recoms),
+                              'appears_in': [],
+                              'appears_in_special': [],
+                              'updated': False
+                              }
+        for tid, data in self.data.items():
+            for x, _ in data['sim_list']:
+                if x in self.data:
+                    self.data[x]['appears_in'].append(tid)
+
+        self._build_index()
+        # embeddings are not part of the snapshot, so that it stays valid
+        # when the word vectors are retrained
+        dense = None
+        if self.embedder is not None:
+            dense = np.stack([self._embed(self.data[tid]['body']) for tid in tids]) if tids \
+                else np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.matrix = SimilarityMatrix.from_arrays(tids, bow_indptr, bow_ids, bow_counts, dates, dense)
+        self._build_lsh()
+        self._load_shards()
+        self._publish()
+        with open(os.path.join(snapshot_dir, 'meta.json'), 'r') as f:
+            # snapshots written before the field was added say nothing
+            # about the log, which is then replayed as a whole
+            self.wal_segment = json.load(f).get('wal_segment', 0)
+        self.logger.info('%d topics loaded from snapshot %s', len(self.data), snapshot_dir)
+
+    def _record(self, topic_id):
+        data = self.data[topic_id]
+        return {'date': data['date'],
+                'body': data['body'],
+                'sim_list': data['sim_list'].to_list(),
+                'appears_in': list(data['appears_in']),
+                'appears_in_special': list(data['appears_in_special'])}
+
+    def write_updates(self, updates, save_dir, num_files_per_folder):
+        '''
+        Writes records captured by capture_updates to disk, one file per
+        topic, each replaced atomically
+        '''
+        records, deleted = updates
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        for tid, record in records.items():
+            path = os.path.join(save_dir, str(int(tid)//num_files_per_folder))
+            # build the subdir for storing topics
+            if not os.path.exists(path):
+                os.makedirs(path)
+            atomic_write(os.path.join(path, tid), json.dumps(record).encode('utf-8'))
+            self.logger.info('Data for topic %s updated on disk', tid)
+
+        for tid in deleted:
+            filename = os.path.join(save_dir, str(int(tid)//num_files_per_folder), tid)
+            if os.path.exists(filename):
+                os.remove(filename)
 
     def save(self, save_dir, num_files_per_folder):
         '''
@@ -360,53 +2130,297 @@ class CorpusSimilarity(AbstractCorpus):
         Args:
         save_dir: directory under which to save the data
         num_files_per_folder: maximum number of saved topic files per folder
-        ''' 
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-
-        for tid, data in self.data.items():
-            if data['updated']:
-                record = {'date': data['date'],
-                          'body': data['body'],
-                          'sim_list': data['sim_list'],
-                          'appears_in': data['appears_in'],
-                          'appears_in_special': data['appears_in_special']}
-                path = os.path.join(save_dir, str(int(tid)//num_files_per_folder))
-                # build the subdir for storing topics
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                filename = os.path.join(path, tid)
-                with open(filename, 'w') as f:
-                    json.dump(record, f)
-                data['updated'] = False
-                self.logger.info('Data for topic %s updated on disk', tid)
-            else:
-                self.logger.info('No updates for topic %s', tid)
+        '''
+        self.write_updates(self.capture_updates(), save_dir, num_files_per_folder)
 
 
 class CorpusInference(AbstractCorpus):
-    def __init__(self, name, target_corpus, logger, num_topics):
+    '''
+    Topic model channel over the topics of a target corpus. An LDA model
+    is trained on the target corpus once it holds min_docs topics and is
+    updated online with mini-batches of batch_size new topics after
+    that. Every topic is represented by its dense topic distribution,
+    so comparing topics costs O(num_topics) whatever the vocabulary size.
+    Training and updating are split into capture_training, fit and
+    install so that only capturing the input and installing the result
+    need the lock guarding the corpus: fit works on a copy of the model,
+    which is replaced rather than changed once installed.
+    '''
+    def __init__(self, name, target_corpus, logger, num_topics, batch_size=256,
+                 min_docs=1000, vocab_size=50000, no_below=2, no_above=0.5):
+        '''
+        num_topics: number of LDA topics, i.e. the dimension of the vectors
+        batch_size: number of new topics per online update of the model
+        min_docs:   number of topics needed to train the initial model
+        vocab_size, no_below, no_above: vocabulary of the model, see
+                    gensim.corpora.Dictionary.filter_extremes
+        '''
         super().__init__(name=name, logger=logger)
         self.target_corpus = target_corpus
         self.num_topics = num_topics
+        self.batch_size = batch_size
+        self.min_docs = min_docs
+        self.vocab_size = vocab_size
+        self.no_below = no_below
+        self.no_above = no_above
         self.lda = None
+        self.vectors = DenseVectors(num_topics)
+        self.pending = []  # bag-of-words vectors of topics not yet used to update the model
+        self.model_version = 0  # bumped whenever the model changes
+        self.saved_version = 0  # model version last written to disk
+
+    def _distributions(self, bows, lda=None):
+        '''
+        Infers the topic distributions of a batch of bag-of-words vectors
+        with lda (the current model by default), leaving a zero vector
+        for those without any known token
+        '''
+        gamma, _ = (self.lda if lda is None else lda).inference(bows)
+        dists = gamma / gamma.sum(axis=1, keepdims=True)
+        dists[[len(bow) == 0 for bow in bows]] = 0
+        return dists
+
+    def capture_training(self):
+        '''
+        Returns what fit needs to train the initial model once there are
+        min_docs topics, or to update the model once batch_size topics are
+        pending, None if neither is due
+        '''
+        if self.lda is None:
+            if len(self.data) < self.min_docs:
+                return None
+            tids = [tid for tid in self.data if tid in self.target_corpus.data]
+            return 'train', tids, [self.target_corpus.data[tid]['body'] for tid in tids]
+        if len(self.pending) < self.batch_size:
+            return None
+        return 'update', self.lda, self.pending[:]
+
+    def fit(self, job):
+        '''
+        Trains the initial model, building its vocabulary and inferring
+        the vectors of the topics it is trained on, or updates a copy of
+        the current model. Leaves the corpus as it is
+        '''
+        start = time.time()
+        if job[0] == 'train':
+            _, tids, bodies = job
+            dictionary = corpora.Dictionary(bodies)
+            dictionary.filter_extremes(no_below=self.no_below, no_above=self.no_above, keep_n=self.vocab_size)
+            bows = [dictionary.doc2bow(body) for body in bodies]
+            lda = LdaModel(corpus=bows, id2word=dictionary, num_topics=self.num_topics,
+                           chunksize=self.batch_size, passes=1, update_every=1, random_state=1)
+            dists = self._distributions(bows, lda)
+            self.logger.info('LDA model with %d topics trained on %d topics (%d tokens) in %.1fs',
+                             self.num_topics, len(tids), len(dictionary), time.time() - start)
+            return lda, dists
+
+        _, lda, bows = job
+        lda = copy.deepcopy(lda)
+        lda.update(bows)
+        self.logger.info('LDA model updated with %d topics in %.1fs (%d updates)',
+                         len(bows), time.time() - start, lda.num_updates)
+        return lda, None
+
+    def install(self, job, result):
+        '''
+        Puts the model fit on a job in place. A newly trained model also
+        brings the vectors of the topics it was trained on, those added
+        while it was trained are inferred here and left pending
+        '''
+        lda, dists = result
+        self.lda = lda
+        self.model_version += 1
+        if job[0] == 'update':
+            del self.pending[:len(job[2])]
+            return
+
+        self.dictionary = lda.id2word
+        kept = [i for i, tid in enumerate(job[1]) if tid in self.data]
+        self.vectors = DenseVectors.from_arrays([job[1][i] for i in kept],
+                                                dists[kept].reshape(len(kept), self.num_topics))
+        self.pending = []
+        for tid, data in self.data.items():
+            data['updated'] = True
+            if tid not in self.vectors and tid in self.target_corpus.data:
+                bow = self.dictionary.doc2bow(self.target_corpus.data[tid]['body'])
+                self.vectors.add(tid, self._distributions([bow])[0])
+                self.pending.append(bow)
+
+    def train(self):
+        '''
+        Trains or updates the model right away if it is due, for when
+        nothing else uses the corpus
+        '''
+        job = self.capture_training()
+        if job is not None:
+            self.install(job, self.fit(job))
+
+    def rebuild(self):
+        '''
+        Registers all topics of the target corpus, training the model if
+        there are enough of them
+        '''
+        self.data = {tid: {'date': data['date'], 'updated': True}
+                     for tid, data in self.target_corpus.data.items()}
+        self._build_index()
+        self.lda = None
+        self.vectors = DenseVectors(self.num_topics)
+        self.pending = []
+        self.train()
 
     def add(self, topic_id, content, date):
-        self.dictionary.add_documents([content])
+        if len(content) == 0:
+            return
+        if topic_id in self.data:
+            self.delete(topic_id)
+
+        self.index.add(topic_id, date)
         self.data[topic_id] = {'date': date,
-                               'body': content,
-                               'updated': False}
+                               'updated': True}
+
+        # the model is trained and updated by capture_training, fit and
+        # install, topics added before it exists get their vectors then
+        if self.lda is not None:
+            bow = self.dictionary.doc2bow(content)
+            self.vectors.add(topic_id, self._distributions([bow])[0])
+            self.pending.append(bow)
 
-        self.lda.update([content])
         self.logger.info('Topic %s added to %s (%d)', topic_id, self.name, len(self.data))
 
     def delete(self, topic_id):
+        if topic_id not in self.data:
+            return
+
         del self.data[topic_id]
+        self.index.delete(topic_id)
+        self.vectors.delete(topic_id)
+        self.deleted.add(topic_id)
 
         self.logger.info('Topic %s deleted (%d)', topic_id, len(self.data))
 
+    def delete_many(self, topic_ids):
+        topic_ids = [tid for tid in topic_ids if tid in self.data]
+        for topic_id in topic_ids:
+            del self.data[topic_id]
+            self.index.delete(topic_id)
+            self.vectors.delete(topic_id)
+        self.deleted.update(topic_ids)
+
+        self.logger.info('%d topics deleted (%d)', len(topic_ids), len(self.data))
+
+    def remove_before(self, t):
+        self.delete_many(self.index.before(t))
+
+    def capture_updates(self, full=False):
+        '''
+        Takes the id's of the topics whose vectors were added since the
+        last capture, or of all topics if full, and of those deleted in
+        the meantime, along with a view of the vectors for most_similar
+        to read without the lock. Rows are only ever zeroed in place or
+        written past those in the view, the matrix is reallocated rather
+        than moved, so the view stays valid
+        '''
+        tids = []
+        for tid, data in self.data.items():
+            if data['updated'] or full:
+                tids.append(tid)
+                data['updated'] = False
+        deleted, self.deleted = self.deleted, set()
+        n = self.vectors.num_rows
+        view = (self.vectors.vectors, self.vectors.ids[:n], self.vectors.alive[:n].copy())
+        return tids, deleted, view
+
+    def most_similar(self, updates, num, block_size=256):
+        '''
+        Returns the up to num [id, similarity]'s of the topics whose topic
+        distributions are closest to that of each topic of a capture that
+        has a vector, most similar first
+        '''
+        matrix, ids, alive = updates[2]
+        n = len(ids)
+        rows = {tid: row for row, tid in enumerate(ids) if tid is not None}
+        query = [rows[tid] for tid in updates[0] if tid in rows]
+        num = min(num, n - 1)
+        similar = {}
+        if num <= 0:
+            return similar
+
+        for start in range(0, len(query), block_size):
+            block = query[start:start+block_size]
+            sims = matrix[block].dot(matrix[:n].T)
+            # rows deleted since the capture are zero, their similarities
+            # too, since topic distributions are never negative
+            sims[:, ~alive] = 0
+            sims[np.arange(len(block)), block] = 0
+            top = np.argpartition(-sims, num-1, axis=1)[:, :num]
+            for i, row in enumerate(block):
+                cols = top[i][np.argsort(-sims[i, top[i]], kind='stable')]
+                similar[ids[row]] = [[ids[col], float(sims[i, col])] for col in cols if sims[i, col] > 0]
+        return similar
+
+    def capture_snapshot(self):
+        '''
+        Copies the topic vectors, and takes the model if it has changed
+        since it was last written, for write_snapshot to write without
+        the lock.
+        The vectors and the index are copied array by array, lining the
+        two up is left to write_snapshot
+        '''
+        live = self.index.alive[self.index.head:self.index.tail]
+        rows = np.flatnonzero(self.vectors.alive[:self.vectors.num_rows])
+        arrays = {'ids': self.index.ids[self.index.head:self.index.tail][live],
+                  'dates': self.index.dates[self.index.head:self.index.tail][live],
+                  'vector_ids': np.array(self.vectors.ids, dtype=object)[rows],
+                  'vectors': self.vectors.vectors[rows]}
+        # installed models are never changed, so write_snapshot can
+        # pickle this one without the lock
+        model = None
+        if self.lda is not None and self.model_version != self.saved_version:
+            model = self.lda
+        return arrays, model, self.model_version
+
+    def write_snapshot(self, snapshot, snapshot_dir):
+        arrays, model, version = snapshot
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        if model is not None:
+            # the model holds its dictionary as id2word
+            atomic_write(os.path.join(snapshot_dir, 'model'), pickle.dumps(model, protocol=4))
+            self.saved_version = version
+
+        rows = {tid: row for row, tid in enumerate(arrays['vector_ids'])}
+        vectors = np.zeros((len(arrays['ids']), self.num_topics), dtype=np.float32)
+        for i, tid in enumerate(arrays['ids']):
+            if tid in rows:
+                vectors[i] = arrays['vectors'][rows[tid]]
+        buf = io.BytesIO()
+        np.savez(buf, ids=arrays['ids'].astype(np.int64), dates=arrays['dates'], vectors=vectors)
+        atomic_write(os.path.join(snapshot_dir, 'vectors.npz'), buf.getvalue())
+        self.logger.info('Vectors of %d topics saved to %s', len(arrays['ids']), snapshot_dir)
+
+    def load_snapshot(self, snapshot_dir):
+        '''
+        Loads the model and topic vectors written by write_snapshot
+        '''
+        model_path = os.path.join(snapshot_dir, 'model')
+        if os.path.exists(model_path):
+            with open(model_path, 'rb') as f:
+                self.lda = pickle.load(f)
+            self.dictionary = self.lda.id2word
+
+        with np.load(os.path.join(snapshot_dir, 'vectors.npz')) as arrays:
+            tids = [str(tid) for tid in arrays['ids'].tolist()]
+            self.data = {tid: {'date': int(date), 'updated': False}
+                         for tid, date in zip(tids, arrays['dates'].tolist())}
+            if self.lda is not None:
+                self.vectors = DenseVectors.from_arrays(tids, arrays['vectors'])
+        self._build_index()
+        self.pending = []
+        self.model_version = self.saved_version = 0
+        self.logger.info('Vectors of %d topics loaded from %s', len(self.data), snapshot_dir)
+
     def load(self, save_dir):
-        pass
+        self.load_snapshot(save_dir)
 
-    def save(self, save_dir, num_files_per_folder):
-        pass
+    def save(self, save_dir, num_files_per_folder=None):
+        self.write_snapshot(self.capture_snapshot(), save_dir)
@@ -0,0 +1,31 @@
+import argparse
+import logging
+import yaml
+from classes import CorpusSimilarity
+
+
+def main(args):
+    with open('config/config.yml', 'rb') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    path_cfg = config['paths']
+    recom_cfg = config['recommendation']
+
+    logging.basicConfig(level=logging.INFO)
+    topics = CorpusSimilarity(name='TOPICS',
+                              time_decay=recom_cfg['time_decay_base'],
+                              duplicate_thresh=recom_cfg['duplicate_thresh'],
+                              irrelevant_thresh=recom_cfg['irrelevant_thresh'],
+                              max_recoms=recom_cfg['max_stored'],
+                              logger=logging.getLogger('convert'))
+
+    topics.load(args.src or path_cfg['topic_save'])
+    topics.save_snapshot(args.dst or path_cfg['topic_snapshot'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert topics saved as one file per topic into a snapshot')
+    parser.add_argument('--src', type=str, help='directory of per-topic files, defaults to paths.topic_save')
+    parser.add_argument('--dst', type=str, help='snapshot directory, defaults to paths.topic_snapshot')
+    args = parser.parse_args()
+    main(args)
@@ -9,7 +9,8 @@ import logging
 import json
 import yaml
 import pika
-from classes import TextPreprocessor, CorpusSimilarity, CorpusTfidf
+from classes import ParallelPreprocessor, CorpusSimilarity, CorpusTfidf, CorpusInference, SIFEmbedder, WriteAheadLog
+from store import RecommendationStore
 import utils
 root_dir = os.path.dirname(sys.path[0])
 config_path = os.path.abspath(os.path.join(root_dir, 'config'))
@@ -19,37 +20,123 @@ NUM_SECONDS_PER_DAY = 86400
 
 
 class Save(threading.Thread):
-    def __init__(self, topics, specials, interval, lock, topic_path,
-                 specials_path, mod_num, logger=None):
+    def __init__(self, topics, specials, inference, interval, lock, topic_path,
+                 specials_path, mod_num, snapshot_path, inference_path, wal, store,
+                 snapshot_every, snapshot_log_size, logger=None):
         threading.Thread.__init__(self)
         self.topics = topics
         self.specials = specials
+        self.inference = inference
         self.interval = interval
         self.lock = lock
         self.topic_path = topic_path
         self.specials_path = specials_path
         self.mod_num = mod_num
+        self.snapshot_path = snapshot_path
+        self.inference_path = inference_path
+        self.wal = wal
+        self.store = store
+        self.snapshot_every = snapshot_every
+        self.snapshot_log_size = snapshot_log_size
         self.logger = logger
 
+        self.last_snapshot = time.time()
+        self.lock_time = 0
+        self.max_lock_time = 0
+        self.save_time = 0
+
     def run(self):
         while True:
             time.sleep(self.interval)
-            with self.lock: 
-                if not os.path.exists(self.topic_path):
-                    os.makedirs(self.topic_path)
-                self.topics.save(self.topic_path, self.mod_num)
-
-                if not os.path.exists(self.specials_path):
-                    os.makedirs(self.specials_path)
-                self.specials.save(self.specials_path, self.mod_num)
+            start = time.time()
+            snapshot = inference_snapshot = None
+            # only copying the data needs the lock, encoding and writing
+            # it are done without blocking message consumption
+            with self.lock:
+                acquired = time.time()
+                # between snapshots the write-ahead log holds the changes
+                # to the topics, only their recommendations are written out
+                take_snapshot = start - self.last_snapshot >= self.snapshot_every \
+                    or self.wal.size() >= self.snapshot_log_size
+                topic_updates = self.topics.capture_updates()
+                special_updates = self.specials.capture_updates()
+                # the topic model similarities of older topics drift as
+                # topics come and go, they are all refreshed with snapshots
+                inference_updates = self.inference.capture_updates(full=take_snapshot)
+                if take_snapshot:
+                    snapshot = self.topics.capture_snapshot()
+                    inference_snapshot = self.inference.capture_snapshot()
+                # everything logged so far is in the copies
+                segment = self.wal.rotate()
+            released = time.time()
+
+            try:
+                sim_lists = {tid: rec['sim_list'] for tid, rec in topic_updates[0].items()}
+                pairs = self.topics.candidate_similarities(sim_lists)
+                similar = self.inference.most_similar(inference_updates, self.store.max_recoms['inference'])
+                if self.topic_path is not None:
+                    self.topics.write_updates(topic_updates, self.topic_path, self.mod_num)
+                self.specials.write_updates(special_updates, self.specials_path, wal_segment=segment)
+                self.store.write('topics', sim_lists, topic_updates[1], pairs)
+                self.store.write('specials', {tid: rec['recommendations'] for tid, rec in special_updates[0].items()},
+                                 special_updates[1])
+                self.store.write('inference', similar, inference_updates[1])
+                if take_snapshot:
+                    self.inference.write_snapshot(inference_snapshot, self.inference_path)
+                    # the topic snapshot goes last: once it records the
+                    # log segments it covers, everything else is on disk
+                    # and those segments are never replayed again
+                    self.topics.write_snapshot(snapshot, self.snapshot_path, segment)
+                    self.wal.discard(segment)
+                    self.last_snapshot = start
+            except Exception:
+                self.logger.exception('Failed to save corpus data')
+                with self.lock:
+                    self.topics.restore_updates(topic_updates)
+                    self.specials.restore_updates(special_updates)
+                    self.inference.restore_updates(inference_updates)
+                continue
+
+            self.lock_time = released - acquired
+            self.max_lock_time = max(self.max_lock_time, self.lock_time)
+            self.save_time = time.time() - start
+            self.logger.info('Saved %d updated topics and %d updated special topics%s: '
+                             'waited %.3fs for the lock, held it for %.3fs (max %.3fs), save took %.3fs',
+                             len(topic_updates[0]), len(special_updates[0]),
+                             ' with a snapshot' if take_snapshot else '', acquired - start,
+                             self.lock_time, self.max_lock_time, self.save_time)
+
+
+def decode_to_dict(msg):
+    while type(msg) != dict:
+        msg = json.loads(msg)
+    return msg
+
+
+def expire(topics, specials, inference, t, backfill):
+    '''
+    Deletes the topics dated before t, purging them from the special
+    topics' recommendations first since that needs their reverse links
+    '''
+    expired = topics.index.before(t)
+    if specials is not None:
+        specials.update_on_delete_topics(expired, backfill)
+    topics.delete_many(expired, backfill)
+    inference.delete_many(expired)
 
 
 class Delete(threading.Thread):
-    def __init__(self, topics, interval, keep_days, lock, logger=None):
+    def __init__(self, topics, specials, inference, interval, keep_days, backfill,
+                 vocab_min_unused, lock, wal, logger=None):
         threading.Thread.__init__(self)
         self.topics = topics
+        self.specials = specials
+        self.inference = inference
+        self.wal = wal
         self.interval = interval
         self.keep_days = keep_days
+        self.backfill = backfill
+        self.vocab_min_unused = vocab_min_unused
         self.lock = lock
         self.logger = logger
 
@@ -57,11 +144,116 @@ class Delete(threading.Thread):
         while True:
             time.sleep(self.interval)
             if self.topics.size == 0:
-                return
+                continue
             with self.lock:
                 t = self.topics.data[self.topics.latest]['date'] - self.keep_days*NUM_SECONDS_PER_DAY
                 self.logger.info('Removing topics older than {}'.format(t))
-                self.topics.remove_before(t)
+                self.wal.append('expire', date=t)
+                self.wal.sync()
+                expire(self.topics, self.specials, self.inference, t, self.backfill)
+                # expired topics leave tokens behind in the dictionaries
+                self.topics.compact_dictionary(self.vocab_min_unused)
+                self.specials.compact_dictionary(self.vocab_min_unused)
+
+
+class Learn(threading.Thread):
+    def __init__(self, inference, interval, lock, logger=None):
+        threading.Thread.__init__(self)
+        self.inference = inference
+        self.interval = interval
+        self.lock = lock
+        self.logger = logger
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            # training and updating the topic model take seconds, only
+            # taking their input and swapping the result in hold the lock
+            with self.lock:
+                job = self.inference.capture_training()
+            if job is None:
+                continue
+            try:
+                result = self.inference.fit(job)
+            except Exception:
+                self.logger.exception('Failed to fit the topic model')
+                continue
+            with self.lock:
+                self.inference.install(job, result)
+
+
+class Query(threading.Thread):
+    '''
+    Answers the old_topics queue on a connection of its own, so that
+    queries wait neither for new topics being scored nor for the lock:
+    they are answered from the published version of the corpus
+    '''
+    def __init__(self, params, exchange, cache, max_recoms, prefetch_count, retry_every, logger=None):
+        threading.Thread.__init__(self)
+        self.params = params
+        self.exchange = exchange
+        self.cache = cache
+        self.max_recoms = max_recoms
+        self.prefetch_count = prefetch_count
+        self.retry_every = retry_every
+        self.logger = logger
+
+    def run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(self.params)
+                channel = connection.channel()
+                channel.basic_qos(prefetch_count=self.prefetch_count)
+                channel.exchange_declare(exchange=self.exchange,
+                                         exchange_type='direct')
+                channel.queue_declare(queue='old_topics')
+                channel.queue_bind(exchange=self.exchange,
+                                   queue='old_topics', routing_key='old')
+
+                def on_old_topic(ch, method, properties, body):
+                    # the body is only tokenized if the result is not cached
+                    topic = decode_to_dict(body)
+                    topic_id = str(topic['topicID'])
+                    self.logger.info('Received old topic %s', topic_id)
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+
+                    sim_list = self.cache.get(topic_id, topic.get('body', ''))
+
+                    sim_list = [tid for tid, val in sim_list][:self.max_recoms]
+
+                    channel.basic_publish(exchange=self.exchange,
+                                          routing_key='old',
+                                          body=json.dumps(sim_list))
+
+                channel.basic_consume('old_topics', on_old_topic)
+                channel.start_consuming()
+
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.info('Retrying in %d seconds', self.retry_every)
+                time.sleep(self.retry_every)
+
+
+class Refill(threading.Thread):
+    def __init__(self, topics, specials, interval, lock, logger=None):
+        threading.Thread.__init__(self)
+        self.topics = topics
+        self.specials = specials
+        self.interval = interval
+        self.lock = lock
+        self.logger = logger
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            # lists refill from their runner-ups as topics are deleted,
+            # only those that have run out of them are rescored here
+            with self.lock:
+                num_topics = self.topics.refill()
+                num_specials = self.specials.refill()
+            if num_topics > 0 or num_specials > 0:
+                self.logger.info('Rescored %d topics and %d special topics that ran short of recommendations',
+                                 num_topics, num_specials)
 
 
 def main(args):  
@@ -82,6 +274,8 @@ def main(args):
     mq_cfg = config['message_queue']
     misc_cfg = config['miscellaneous']
     special_cfg = config['special_topics']
+    inference_cfg = config['inference']
+    emb_cfg = config['embedding']
     logger = utils.get_logger_with_config(name=log_cfg['run_log_name'],
                                           logger_level=log_cfg['log_level'],
                                           handler_levels=log_cfg['handler_levels'],
@@ -93,20 +287,37 @@ def main(args):
     # load stopwords
     stopwords = utils.load_stopwords(path_cfg['stopwords'])
 
-    preprocessor = TextPreprocessor(singles=pre_cfg['singles'],
-                                    puncs=pre_cfg['punctuations'],
-                                    punc_frac_low=pre_cfg['min_punc_frac'],
-                                    punc_frac_high=pre_cfg['max_punc_frac'],
-                                    valid_count=pre_cfg['min_count'],
-                                    valid_ratio=pre_cfg['min_ratio'],
-                                    stopwords=stopwords)
+    preprocessor = ParallelPreprocessor(num_workers=pre_cfg['num_workers'],
+                                        singles=pre_cfg['singles'],
+                                        puncs=pre_cfg['punctuations'],
+                                        punc_frac_low=pre_cfg['min_punc_frac'],
+                                        punc_frac_high=pre_cfg['max_punc_frac'],
+                                        valid_count=pre_cfg['min_count'],
+                                        valid_ratio=pre_cfg['min_ratio'],
+                                        stopwords=stopwords)
+
+    embedder = None
+    if emb_cfg['weight'] > 0:
+        if os.path.exists(path_cfg['word_vectors']):
+            embedder = SIFEmbedder(path_cfg['word_vectors'], a=emb_cfg['sif_a'])
+        else:
+            logger.warning('Word vectors not found at %s, run train_word2vec.py to enable embedding similarity',
+                           path_cfg['word_vectors'])
 
     topics = CorpusSimilarity(name='TOPICS',
                               time_decay=recom_cfg['time_decay_base'],
                               duplicate_thresh=recom_cfg['duplicate_thresh'],
                               irrelevant_thresh=recom_cfg['irrelevant_thresh'],
                               max_recoms=recom_cfg['max_stored'],
-                              logger=utils.get_logger(log_cfg['run_log_name']+'.topics')
+                              logger=utils.get_logger(log_cfg['run_log_name']+'.topics'),
+                              max_overflow=recom_cfg['max_overflow'],
+                              lsh_num_perm=recom_cfg['lsh_num_perm'],
+                              lsh_num_bands=recom_cfg['lsh_num_bands'],
+                              lsh_recall_sample=recom_cfg['lsh_recall_sample'],
+                              embedder=embedder,
+                              embedding_weight=emb_cfg['weight'],
+                              embedding_candidates=emb_cfg['num_candidates'],
+                              num_shards=recom_cfg['num_shards']
                               )
 
     specials = CorpusTfidf(name='SPECIAL TOPICS',
@@ -115,19 +326,90 @@ def main(args):
                            num_keywords=special_cfg['num_keywords'],
                            time_decay=recom_cfg['time_decay_base'],
                            max_recoms=recom_cfg['max_stored_special'],
-                           logger=utils.get_logger(log_cfg['run_log_name']+'.specials')
+                           logger=utils.get_logger(log_cfg['run_log_name']+'.specials'),
+                           max_overflow=recom_cfg['max_overflow_special']
                            )
 
+    inference = CorpusInference(name='INFERENCE',
+                                target_corpus=topics,
+                                logger=utils.get_logger(log_cfg['run_log_name']+'.inference'),
+                                num_topics=inference_cfg['num_topics'],
+                                batch_size=inference_cfg['batch_size'],
+                                min_docs=inference_cfg['min_docs'],
+                                vocab_size=inference_cfg['vocab_size']
+                                )
+
     # load previously saved corpus and similarity data if possible
     if args.l:
         try:
-            topics.load(path_cfg['topic_save'])
+            if os.path.exists(path_cfg['topic_snapshot']):
+                topics.load_snapshot(path_cfg['topic_snapshot'])
+            else:
+                topics.load(path_cfg['topic_save'])
         except FileNotFoundError:
             logger.exception('Topic data files not found. New files will be created')
         try:
             specials.load(path_cfg['special_save'])
         except FileNotFoundError:
             logger.exception('Special topic data files not found. New files will be created')
+        if os.path.exists(path_cfg['inference_snapshot']):
+            inference.load_snapshot(path_cfg['inference_snapshot'])
+        else:
+            inference.rebuild()
+
+    def apply(record, skip_specials=False):
+        '''
+        Applies a corpus mutation recorded in the write-ahead log, leaving
+        out its effect on the special topics if they already reflect it
+        '''
+        op = record['op']
+        if op == 'add':
+            topics.add(record['topic_id'], record['content'], record['date'])
+            if not skip_specials:
+                specials.update_on_new_topic(record['topic_id'], record['content'], record['date'])
+            inference.add(record['topic_id'], record['content'], record['date'])
+        elif op == 'special':
+            if not skip_specials:
+                specials.add(record['topic_id'], record['content'], record['date'])
+        elif op == 'delete':
+            if not skip_specials:
+                specials.update_on_delete_topic(record['topic_id'])
+            topics.delete(record['topic_id'])
+            inference.delete(record['topic_id'])
+        elif op == 'expire':
+            expire(topics, None if skip_specials else specials, inference, record['date'],
+                   main_cfg['expire_backfill'])
+
+    wal = WriteAheadLog(path_cfg['wal'], logger=utils.get_logger(log_cfg['run_log_name']+'.wal'))
+    if args.l:
+        # replay the mutations logged after the snapshot that was loaded.
+        # The special topics are saved more often than the snapshot, so
+        # the first segments only need replaying on the topics
+        num_replayed = 0
+        for record in wal.replay(topics.wal_segment, specials.wal_segment):
+            apply(record, skip_specials=True)
+            num_replayed += 1
+        specials.relink()
+        for record in wal.replay(max(topics.wal_segment, specials.wal_segment)):
+            apply(record)
+            num_replayed += 1
+        logger.info('%d logged operations replayed', num_replayed)
+    else:
+        wal.discard(wal.current)
+
+    store = RecommendationStore(path_cfg['recommendation_store'],
+                                max_recoms={'topics': recom_cfg['max_stored'],
+                                            'specials': recom_cfg['max_stored_special'],
+                                            'inference': recom_cfg['max_stored']})
+    if store.count('topics') == 0 and topics.data:
+        # first run against an existing corpus, the Save thread only
+        # writes what changes after this
+        sim_lists = {tid: data['sim_list'].to_list() for tid, data in topics.data.items()}
+        store.write('topics', sim_lists, pairs=topics.candidate_similarities(sim_lists))
+        store.write('specials', {tid: data['recommendations'].to_list() for tid, data in specials.data.items()})
+    if store.count('inference') == 0 and len(inference.vectors) > 0:
+        store.write('inference', inference.most_similar(inference.capture_updates(full=True),
+                                                        recom_cfg['max_stored']))
 
     # establish rabbitmq connection and declare queues
     if args.c:
@@ -138,105 +420,178 @@ def main(args):
     else:
         params = pika.ConnectionParameters(host='localhost')
 
+    def query_old_topic(topic_id, text):
+        return topics.find_most_similar({'topic_id': topic_id, 'body': preprocessor.preprocess(text)})
+
+    # query results for old topics, recomputed once a new version of the
+    # corpus has been published
+    old_topic_cache = utils.LRUCache(max_size=main_cfg['old_topic_cache_size'],
+                                     check_every=0,
+                                     loader=query_old_topic,
+                                     signature=lambda topic_id: topics.published.generation)
+
+    # serializes the writers (message callbacks, Delete, Refill, Learn) and the
+    # capture of updates by Save. Queries read topics.published instead
+    # and never take it
     lock = threading.Lock()
     save_topics = Save(topics=topics,
                        specials=specials,
+                       inference=inference,
                        interval=main_cfg['save_every'],
                        lock=lock,
-                       topic_path=path_cfg['topic_save'],
+                       topic_path=path_cfg['topic_save'] if main_cfg['save_topic_files'] else None,
                        specials_path=path_cfg['special_save'],
-                       mod_num=misc_cfg['num_topic_files_per_folder'])
+                       mod_num=misc_cfg['num_topic_files_per_folder'],
+                       snapshot_path=path_cfg['topic_snapshot'],
+                       inference_path=path_cfg['inference_snapshot'],
+                       wal=wal,
+                       store=store,
+                       snapshot_every=main_cfg['snapshot_every'],
+                       snapshot_log_size=main_cfg['snapshot_log_mb']*2**20,
+                       logger=utils.get_logger(log_cfg['run_log_name']+'.save'))
     
     save_topics.start()
 
     delete_topics = Delete(topics=topics,
+                           specials=specials,
+                           inference=inference,
                            interval=main_cfg['delete_every'],
                            keep_days=main_cfg['keep_days'],
+                           backfill=main_cfg['expire_backfill'],
+                           vocab_min_unused=main_cfg['vocab_min_unused'],
                            lock=lock,
+                           wal=wal,
                            logger=utils.get_logger(log_cfg['run_log_name']+'.topics'))
 
     delete_topics.start()
+
+    refill_topics = Refill(topics=topics,
+                           specials=specials,
+                           interval=main_cfg['refill_every'],
+                           lock=lock,
+                           logger=utils.get_logger(log_cfg['run_log_name']+'.topics'))
+
+    refill_topics.start()
+
+    learn_topics = Learn(inference=inference,
+                         interval=inference_cfg['train_every'],
+                         lock=lock,
+                         logger=utils.get_logger(log_cfg['run_log_name']+'.inference'))
+
+    learn_topics.start()
+
+    query_topics = Query(params=params,
+                         exchange=mq_cfg['exchange_name'],
+                         cache=old_topic_cache,
+                         max_recoms=recom_cfg['max_stored'],
+                         prefetch_count=main_cfg['prefetch_count'],
+                         retry_every=main_cfg['retry_every'],
+                         logger=utils.get_logger(log_cfg['run_log_name']+'.query'))
+
+    query_topics.start()
     
     while True:       
         try:
             exchange = mq_cfg['exchange_name']
             connection = pika.BlockingConnection(params)
             channel = connection.channel()
-            channel.basic_qos(prefetch_count=1)
+            channel.basic_qos(prefetch_count=main_cfg['prefetch_count'])
             channel.exchange_declare(exchange=mq_cfg['exchange_name'], 
                                      exchange_type='direct')
           
             channel.queue_declare(queue='new_topics')
-            channel.queue_declare(queue='old_topics')
             channel.queue_declare(queue='special_topics')
             channel.queue_declare(queue='delete_topics')
 
             channel.queue_bind(exchange=exchange, 
                                queue='new_topics', routing_key='new')
-            channel.queue_bind(exchange=exchange,
-                               queue='old_topics', routing_key='old')
             channel.queue_bind(exchange=exchange,
                                queue='special_topics', routing_key='special')
             channel.queue_bind(exchange=exchange, 
                                queue='delete_topics', routing_key='delete')
             
-            def decode_to_dict(msg):
-                while type(msg) != dict:
-                    msg = json.loads(msg)
-                return msg
-
-            def get_topic_data(topic):
+            def get_topic_data(topic, submit=False):
+                '''
+                Returns the topic id, the tokenized body and the date of a
+                topic message. If submit is True the body is only submitted
+                for tokenization and a handle to the result is returned
+                instead, to be collected with preprocessor.get
+                '''
                 topic = decode_to_dict(topic)
                 topic_id = str(topic['topicID'])
-                content = preprocessor.preprocess(topic['body']) if 'body' in topic else []
+                content = preprocessor.submit(topic.get('body', ''))
+                if not submit:
+                    content = preprocessor.get(content)
                 date = topic['postDate']//misc_cfg['timestamp_factor'] if 'postDate' in topic else -1
 
                 return topic_id, content, date
 
-            def on_new_topic(ch, method, properties, body):
-                topic_id, content, date = get_topic_data(body)
-
+            # new topics are buffered and scored in batches of up to
+            # batch_size, waiting no more than batch_wait seconds
+            pending = []
+            batch_timer = [None]
+
+            def process_new_topics():
+                if batch_timer[0] is not None:
+                    connection.remove_timeout(batch_timer[0])
+                    batch_timer[0] = None
+                if len(pending) == 0:
+                    return
+
+                depth = preprocessor.depth
+                batch = [(topic_id, preprocessor.get(content), date)
+                         for _, (topic_id, content, date) in pending]
                 with lock:
-                    topics.add(topic_id, content, date)
-                    specials.update_on_new_topic(topic_id, content, date)
-
-                channel.basic_ack(delivery_tag=method.delivery_tag)      
+                    for topic_id, content, date in batch:
+                        wal.append('add', topic_id=topic_id, content=content, date=date)
+                    wal.sync()
+                    topics.add_batch(batch)
+                    for topic_id, content, date in batch:
+                        specials.update_on_new_topic(topic_id, content, date)
+                        inference.add(topic_id, content, date)
+
+                channel.basic_ack(delivery_tag=pending[-1][0], multiple=True)
+                logger.info('Processed a batch of %d new topics (tokenization queue depth %d, max %d)',
+                            len(pending), depth, preprocessor.max_depth)
+                del pending[:]
+
+            def on_batch_timeout():
+                batch_timer[0] = None
+                process_new_topics()
 
-            def on_old_topic(ch, method, properties, body):
-                topic_id, content, date = get_topic_data(body)
-                logger.info('Received old topic %s', topic_id)
-                channel.basic_ack(delivery_tag=method.delivery_tag)
-
-                with lock:
-                    sim_list = topics.find_most_similar(content)
-
-                sim_list = [tid for tid, val in sim_list][recom_cfg['max_stored']]
-                
-                channel.basic_publish(exchange=exchange,
-                                      routing_key='old',
-                                      body=json.dumps(sim_list))
+            def on_new_topic(ch, method, properties, body):
+                # tokenization starts in the background right away
+                pending.append((method.delivery_tag, get_topic_data(body, submit=True)))
+                if len(pending) >= main_cfg['batch_size']:
+                    process_new_topics()
+                elif batch_timer[0] is None:
+                    batch_timer[0] = connection.call_later(main_cfg['batch_wait'], on_batch_timeout)
 
             def on_special_topic(ch, method, properties, body):
                 topic_id, content, date = get_topic_data(body)
 
                 with lock:
+                    wal.append('special', topic_id=topic_id, content=content, date=date)
+                    wal.sync()
                     specials.add(topic_id, content, date)
-                
+
                 channel.basic_ack(delivery_tag=method.delivery_tag) 
 
             def on_delete(ch, method, properties, body):
                 topic_id, _, _ = get_topic_data(body)
                 
                 with lock:
+                    wal.append('delete', topic_id=topic_id)
+                    wal.sync()
                     specials.update_on_delete_topic(topic_id)
                     topics.delete(topic_id)
+                    inference.delete(topic_id)
 
                 channel.basic_ack(delivery_tag=method.delivery_tag)
 
             channel.basic_consume('new_topics', on_new_topic)
             channel.basic_consume('special_topics', on_special_topic)
             channel.basic_consume('delete_topics', on_delete)
-            channel.basic_consume('old_topics', on_old_topic)
             '''
             channel.basic_consume(on_update_topic, queue='update_topics')                                  
             '''    
@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+TABLES = ('topics', 'specials', 'inference')
+
+
+class RecommendationStore(object):
+    '''
+    Read-optimized store of the recommendations served for each topic,
+    kept apart from the topic bodies in an SQLite database. Every topic
+    has one fixed-width record holding the ids (int64, padded with -1)
+    and the scores (float32) of its top recommendations, so
+    serving a topic is a single primary key lookup with no parsing.
+    A record may also hold the similarities (float32) among its
+    recommendations, used to diversify them when served.
+    The database is in WAL mode, which lets the serve views read while
+    the consumer writes. Connections are kept per thread.
+    '''
+    def __init__(self, path, max_recoms):
+        '''
+        path: database file
+        max_recoms: mapping from table name to the number of
+                    recommendations stored per topic in it
+        '''
+        self.path = path
+        self.max_recoms = max_recoms
+        self.local = threading.local()
+        self.version_lock = threading.Lock()
+        self.version_conn = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.connection as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for table in TABLES:
+                conn.execute('CREATE TABLE IF NOT EXISTS {} ('
+                             'topic_id INTEGER PRIMARY KEY, '
+                             'ids BLOB NOT NULL, '
+                             'scores BLOB NOT NULL, '
+                             'pairs BLOB)'.format(table))
+                # stores created before pairs were kept lack the column
+                columns = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+                if 'pairs' not in columns:
+                    conn.execute('ALTER TABLE {} ADD COLUMN pairs BLOB'.format(table))
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self.local.conn = conn
+        return conn
+
+    def _encode(self, table, recoms):
+        width = self.max_recoms[table]
+        recoms = recoms[:width]
+        ids = np.full(width, -1, dtype=np.int64)
+        scores = np.zeros(width, dtype=np.float32)
+        for i, (tid, score) in enumerate(recoms):
+            ids[i] = int(tid)
+            scores[i] = score
+        return ids.tobytes(), scores.tobytes()
+
+    def _encode_pairs(self, table, sims):
+        width = self.max_recoms[table]
+        n = min(len(sims), width)
+        pairs = np.zeros((width, width), dtype=np.float32)
+        pairs[:n, :n] = np.asarray(sims)[:n, :n]
+        return pairs.tobytes()
+
+    @staticmethod
+    def _decode(ids, scores):
+        ids = np.frombuffer(ids, dtype=np.int64)
+        n = int(np.count_nonzero(ids >= 0))
+        return [[str(tid), score] for tid, score in
+                zip(ids[:n].tolist(), np.frombuffer(scores, dtype=np.float32)[:n].tolist())]
+
+    def write(self, table, records, deleted=(), pairs=None):
+        '''
+        Replaces the records of the given topics and removes the deleted
+        ones in a single transaction
+        Args:
+        table: 'topics', 'specials' or 'inference'
+        records: mapping from topic id to its list of [id, score]'s
+        deleted: id's of topics to remove
+        pairs: optional mapping from topic id to the square array of
+               similarities among its recommendations
+        '''
+        pairs = pairs or {}
+        rows = [(int(tid),) + self._encode(table, recoms)
+                + ((self._encode_pairs(table, pairs[tid]) if tid in pairs else None),)
+                for tid, recoms in records.items()]
+        with self.connection as conn:
+            conn.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?)'.format(table), rows)
+            conn.executemany('DELETE FROM {} WHERE topic_id = ?'.format(table),
+                             [(int(tid),) for tid in deleted])
+
+    def get(self, table, topic_id, num=None, with_pairs=False):
+        '''
+        Returns the top num recommendations of a topic as a list of
+        [id, score]'s, or None if the topic is not in the store. With
+        with_pairs, returns the list along with the num x num array of
+        similarities among them (None if they were not stored)
+        '''
+        row = self.connection.execute('SELECT ids, scores, pairs FROM {} WHERE topic_id = ?'.format(table),
+                                      (int(topic_id),)).fetchone()
+        if row is None:
+            return None
+        recoms = self._decode(row[0], row[1])[:num]
+        if not with_pairs:
+            return recoms
+        pairs = None
+        if row[2] is not None:
+            width = self.max_recoms[table]
+            n = len(recoms)
+            pairs = np.frombuffer(row[2], dtype=np.float32).reshape(width, width)[:n, :n]
+        return recoms, pairs
+
+    def count(self, table):
+        return self.connection.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+    def version(self):
+        '''
+        Changes whenever another connection commits to the database. One
+        connection is shared by all threads for this so that versions
+        seen by different threads are comparable
+        '''
+        with self.version_lock:
+            if self.version_conn is None:
+                self.version_conn = sqlite3.connect(self.path, check_same_thread=False)
+            return self.version_conn.execute('PRAGMA data_version').fetchone()[0]
@@ -0,0 +1,54 @@
+import json
+import argparse
+import yaml
+import numpy as np
+from gensim.models import Word2Vec
+from classes import TextPreprocessor, SIFEmbedder
+import utils
+
+
+def main(args):
+    with open('config/config.yml', 'rb') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    pre_cfg = config['preprocessing']
+    emb_cfg = config['embedding']
+    vectors_path = config['paths']['word_vectors']
+    preprocessor = TextPreprocessor(singles=pre_cfg['singles'],
+                                    puncs=pre_cfg['punctuations'],
+                                    punc_frac_low=pre_cfg['min_punc_frac'],
+                                    punc_frac_high=pre_cfg['max_punc_frac'],
+                                    valid_count=pre_cfg['min_count'],
+                                    valid_ratio=pre_cfg['min_ratio'],
+                                    stopwords=utils.load_stopwords(config['paths']['stopwords']))
+
+    with open(config['paths']['topics'], 'r') as f:
+        texts = [topic['body'] for topic in json.load(f).values() if topic['body']]
+
+    sentences = [words for words in map(preprocessor.preprocess, texts) if len(words) > 0]
+    print('training on {} documents'.format(len(sentences)))
+
+    model = Word2Vec(sentences=sentences,
+                     vector_size=emb_cfg['vector_size'],
+                     window=emb_cfg['window'],
+                     min_count=emb_cfg['min_count'],
+                     epochs=emb_cfg['epochs'],
+                     workers=args.workers)
+    model.wv.save(vectors_path)
+
+    # the common component of the SIF embeddings of the training
+    # documents, removed from every embedding at serving time
+    embedder = SIFEmbedder(vectors_path, a=emb_cfg['sif_a'])
+    embeddings = np.stack([embedder.embed(words, remove_pc=False) for words in sentences])
+    _, _, vt = np.linalg.svd(embeddings, full_matrices=False)
+    np.save(vectors_path + '.pc.npy', vt[0])
+
+    print('{} word vectors of dimension {} saved to {}'.format(
+        len(model.wv), model.wv.vector_size, vectors_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=4, help='number of training threads')
+    args = parser.parse_args()
+    main(args)
@@ -1,5 +1,11 @@
+import asyncio
 import logging
 import os
+import time
+import threading
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
 
 
 def load_stopwords(stopwords_path):
@@ -45,44 +51,225 @@ def get_logger(name):
     return logging.getLogger(name)
 
 
-def insert(l, id_, value, max_len):
+class LRUCache(object):
     '''
-    Helper function to insert into a list of [id, value]'s sorted
-    by value, keeping the length of the list no more than max_len.
-    Returns None if no insertion is performed, -1 if insertion is
-    performed but no element is removed from the original list and
-    the removed id if the insertion is performed and an element is
-    removed from the list.
+    Thread-safe LRU cache holding at most max_size entries. Each entry is
+    stored along with a signature of its source, e.g. the modification
+    time, inode and size of a file or the version of a database, and is
+    reloaded once the signature changes. Signatures are checked at most
+    once every check_every seconds, in between entries are served
+    without touching their source. Extra arguments to get are passed on
+    to the loader when the entry is (re)loaded.
     '''
-    if value == 0 or (len(l) == max_len and value < l[-1][1]):
-        return
+    def __init__(self, max_size, check_every, loader, signature):
+        self.max_size = max_size
+        self.check_every = check_every
+        self.loader = loader  # function mapping a key to the value to cache
+        self.signature = signature  # function mapping a key to the signature of its source
+        self.entries = OrderedDict()  # key -> [value, signature, time of last check]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    i = 0
-    while i < len(l) and l[i][1] > value:
-        i += 1
+    def get(self, key, *args):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[2] < self.check_every:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
 
-    l.insert(i, [id_, value])
+        signature = self.signature(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == signature:
+                entry[2] = now
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
 
-    if len(l) > max_len:
-        deleted_id = l[-1][0]
-        del l[-1]
-        return deleted_id
+        value = self.loader(key, *args)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = [value, signature, now]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
 
-    return ''
+        return value
 
-def remove(l, id_):
-    """
-    Helper function to remove from a list of [id, value]'s the entry whose
-    zeroth element is -id_
-    """
-    if len(l) == 0:
-        return
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
 
-    i = 0
-    while i < len(l) and l[i][0] != id_:
-        i += 1
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries),
+                    'maxSize': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitRate': self.hits / total if total > 0 else 0.0}
 
-    if i == len(l):
-        return
 
-    del l[i]
\ No newline at end of file
+async def lookup_within(lookup, keys, timeout, executor):
+    '''
+    Runs lookup(key) for every key concurrently on executor and waits
+    for at most timeout seconds. Returns a dict mapping each key to
+    [value, exception, seconds taken], all None for the lookups still
+    running at the deadline. These are left to finish in the background
+    and warm the cache for later requests
+    '''
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+
+    def timed(key):
+        try:
+            return lookup(key), None, time.perf_counter() - start
+        except Exception as e:
+            return None, e, time.perf_counter() - start
+
+    futures = {key: loop.run_in_executor(executor, timed, key) for key in keys}
+    if futures:
+        await asyncio.wait(futures.values(), timeout=timeout)
+
+    return {key: list(future.result()) if future.done() else [None, None, None]
+            for key, future in futures.items()}
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+
+def atomic_write(path, data):
+    '''
+    Writes bytes to a hidden temporary file next to path and renames it
+    over path, so that readers never see a partially written file
+    '''
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TopK(object):
+    '''
+    Bounded list of [id, value]'s sorted by value in descending order,
+    holding no more than max_len entries. Entries are kept in two
+    parallel arrays (ids and negated values) so that the insertion
+    point is found by bisection, and an id-to-value map answers
+    membership tests and locates entries for removal by bisection as
+    well. Inserting and removing shift the arrays, which is cheap for
+    the few dozen entries a list holds. The list is flagged as
+    truncated once an entry has been dropped or turned away for lack
+    of room, i.e. once it may be missing candidates.
+    '''
+    def __init__(self, max_len, items=None):
+        self.max_len = max_len
+        self.ids = []
+        self.keys = array('d')  # negated values in ascending order
+        self.values = {}
+        self.truncated = False
+        for id_, value in items or []:
+            self.insert(id_, value)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id_):
+        return id_ in self.values
+
+    def __iter__(self):
+        for id_, key in zip(self.ids, self.keys):
+            yield id_, -key
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [[id_, -key] for id_, key in zip(self.ids[i], self.keys[i])]
+        return [self.ids[i], -self.keys[i]]
+
+    def __repr__(self):
+        return 'TopK({}, {})'.format(self.max_len, self.to_list())
+
+    def insert(self, id_, value):
+        '''
+        Inserts id_ with the given value, keeping the length of the list
+        no more than max_len. An entry already present for id_ is
+        replaced. Returns None if no insertion is performed, '' if
+        insertion is performed but no element is removed from the list
+        and the removed id if the insertion is performed and an element
+        is removed from the list.
+        '''
+        if value == 0:
+            return
+        if id_ in self.values:
+            if self.values[id_] == value:
+                return
+            self.remove(id_)
+        elif len(self.ids) >= self.max_len and value < -self.keys[-1]:
+            self.truncated = True
+            return
+
+        # ties go in front of the existing entries with the same value
+        i = bisect_left(self.keys, -value)
+        self.keys.insert(i, -value)
+        self.ids.insert(i, id_)
+        self.values[id_] = value
+
+        if len(self.ids) > self.max_len:
+            deleted_id = self.ids.pop()
+            self.keys.pop()
+            del self.values[deleted_id]
+            self.truncated = True
+            return deleted_id
+
+        return ''
+
+    def remove(self, id_):
+        '''
+        Removes the entry for id_ if there is one
+        '''
+        value = self.values.pop(id_, None)
+        if value is None:
+            return
+
+        i = bisect_left(self.keys, -value)
+        while self.ids[i] != id_:
+            i += 1
+
+        del self.ids[i]
+        del self.keys[i]
+
+    def to_list(self):
+        return self[:]
+
+    @classmethod
+    def from_list(cls, l, max_len, truncated=None):
+        '''
+        Builds the list from [id, value]'s already sorted by value. As it
+        is unknown whether the entries were cut from a longer list, it
+        is flagged as truncated if full unless told otherwise
+        '''
+        topk = cls(max_len)
+        for id_, value in l:
+            topk.ids.append(id_)
+            topk.keys.append(-value)
+            topk.values[id_] = value
+        topk.truncated = len(topk.ids) >= max_len if truncated is None else truncated
+        return topk
+
+
+def discard(l, id_):
+    '''
+    Helper function to remove the first occurrence of id_ from a list
+    of id's if there is one
+    '''
+    try:
+        l.remove(id_)
+    except ValueError:
+        pass